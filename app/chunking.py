@@ -0,0 +1,95 @@
+import math
+import zlib
+import struct
+
+# Content-defined chunking for big files, opt-in with ChunkedBlobThreshold
+# in .ctrlz/config.json. A file at or over the threshold is cut where its
+# content says so rather than at fixed offsets, so an edit only changes the
+# chunks around it and the rest dedupe against the previous version. Each
+# chunk is stored as an ordinary blob and the file as a "manifest" object
+# listing them in order, <20-byte chunk id><8-byte big-endian size> each;
+# trees point at the manifest.
+#
+# The cut test is a rolling hash over the WINDOW bytes before a position:
+# their sum after mapping through TABLE. Where its low byte is CANDIDATE
+# (odd, so a run of one byte or a short repeating pattern never qualifies)
+# the window's crc32, masked down to give the average chunk size asked for,
+# decides. The sums for a whole block come out of big-int arithmetic rather
+# than a Python loop per byte: each byte gets a 16-bit lane, and adding
+# shifted copies (x + (x << 16), then << 32, ...) leaves every lane holding
+# the sum of the WINDOW lanes up to it.
+#
+# Config keys:
+#   ChunkedBlobThreshold  files this big or bigger are chunked (unset: never)
+#   ChunkAverageSize      target chunk size; chunks are 1/4x to 4x of it
+WINDOW = 64
+CANDIDATE = 0x55
+TABLE = bytes(sorted(range(256), key=lambda b: zlib.crc32(bytes([b]))))
+DEFAULT_AVERAGE = 1024 * 1024
+BLOCK = 256 * 1024
+MANIFEST_ENTRY = struct.Struct(">20sQ")
+
+
+def window_sums(data: bytes) -> bytes:
+    # Byte k: low byte of the rolling sum over data[k:k + WINDOW]
+    lanes = bytearray(2 * len(data))
+    lanes[0::2] = data.translate(TABLE)
+    x = int.from_bytes(lanes, "little")
+    shift = 16
+    while shift < 16 * WINDOW:
+        x += x << shift
+        shift *= 2
+    return x.to_bytes(2 * (len(data) + WINDOW), "little")[2 * (WINDOW - 1):2 * len(data):2]
+
+
+class Chunker:
+    def __init__(self, average: int = DEFAULT_AVERAGE):
+        self.min_size = max(WINDOW, average // 4)
+        self.max_size = max(self.min_size + 1, average * 4)
+        # Candidates come up about once every 256 bytes; past min_size the
+        # crc32 test thins them to one per (average - min_size) bytes
+        self.mask = (1 << round(math.log2(max(1, (average - self.min_size) / 256)))) - 1
+
+    def find_cut(self, buf) -> int:
+        # Where the first chunk of buf ends, or None if nothing qualifies
+        # before max_size (or the end of buf)
+        end = min(len(buf), self.max_size)
+        low = self.min_size
+        while low < end:
+            high = min(end, low + BLOCK)
+            block = bytes(buf[low - WINDOW:high])
+            sums = window_sums(block)
+            at = sums.find(CANDIDATE)
+            while at != -1:
+                if not zlib.crc32(block[at:at + WINDOW]) & self.mask:
+                    return low + at
+                at = sums.find(CANDIDATE, at + 1)
+            low = high
+        return None
+
+    def split(self, f):
+        # Yields the chunks of binary file f, holding at most ~2 * max_size
+        buf = bytearray()
+        eof = False
+        while True:
+            while not eof and len(buf) < self.max_size:
+                data = f.read(self.max_size)
+                if not data:
+                    eof = True
+                buf += data
+            if not buf:
+                return
+            cut = self.find_cut(buf)
+            if cut is None:
+                cut = min(len(buf), self.max_size)
+            yield bytes(buf[:cut])
+            del buf[:cut]
+
+
+def format_manifest(chunks) -> bytes:
+    # chunks: [(chunk id, size)] in file order
+    return b"".join(MANIFEST_ENTRY.pack(bytes.fromhex(sha), size) for sha, size in chunks)
+
+
+def parse_manifest(content: bytes):
+    return [(sha.hex(), size) for sha, size in MANIFEST_ENTRY.iter_unpack(content)]
@@ -0,0 +1,29 @@
+# Stand-ins for colorama's Fore and Style. colorama is only imported, and
+# its autoreset stream wrappers installed, the first time a color is used,
+# so commands that print plain output never load it.
+
+
+class _Lazy:
+    def __init__(self, name: str):
+        self._name = name
+
+    def __getattr__(self, attr):
+        import colorama
+        _init(colorama)
+        value = getattr(getattr(colorama, self._name), attr)
+        setattr(self, attr, value)
+        return value
+
+
+_initialized = False
+
+
+def _init(colorama):
+    global _initialized
+    if not _initialized:
+        colorama.init(autoreset=True)
+        _initialized = True
+
+
+Fore = _Lazy("Fore")
+Style = _Lazy("Style")
@@ -0,0 +1,122 @@
+import os
+import mmap
+import struct
+from typing import NamedTuple
+
+GRAPH_PATH = ".ctrlz/commit-graph"
+
+# header | one fixed-width row per commit, in the order they were added.
+# Parents are stored as row positions, so rows never move once written and
+# new commits are a single append.
+MAGIC = b"CZCG"
+VERSION = 1
+HEADER = struct.Struct(">4sII")            # magic, version, commit count
+ROW = struct.Struct(">20s20sIIq")         # sha, tree, parent position, generation, timestamp
+NO_PARENT = 0xFFFFFFFF
+
+
+class GraphCommit(NamedTuple):
+    position: int
+    sha: str
+    tree: str
+    parent: int      # row position, or None for a root commit
+    generation: int
+    timestamp: int
+
+
+class CommitGraph:
+    def __init__(self, path: str = GRAPH_PATH):
+        self.path = path
+        self.count = 0
+        self._map = None
+        self._positions = None
+
+        if not os.path.exists(path) or os.path.getsize(path) < HEADER.size:
+            return
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise RuntimeError(f"{path} is not a ctrlz commit-graph")
+        # Rows past the header count are a torn append; ignore them
+        self.count = min(count, (len(self._map) - HEADER.size) // ROW.size)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+    def __getitem__(self, position: int) -> GraphCommit:
+        sha, tree, parent, generation, timestamp = ROW.unpack_from(self._map, HEADER.size + position * ROW.size)
+        return GraphCommit(position, sha.hex(), tree.hex(), None if parent == NO_PARENT else parent,
+                           generation, timestamp)
+
+    def position(self, sha: str):
+        if self._positions is None:
+            self._positions = {}
+            for i in range(self.count):
+                start = HEADER.size + i * ROW.size
+                self._positions[self._map[start:start + 20].hex()] = i
+        return self._positions.get(sha)
+
+    def lookup(self, sha: str):
+        position = self.position(sha)
+        return None if position is None else self[position]
+
+    def walk(self, sha: str):
+        # First-parent history starting at sha, newest first
+        position = self.position(sha)
+        while position is not None:
+            commit = self[position]
+            yield commit
+            position = commit.parent
+
+
+def append_commits(commits, path: str = GRAPH_PATH):
+    # commits: (sha, tree, parent sha, timestamp), parents before children
+    if not os.path.exists(path):
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, 0))
+
+    rows = []
+    with CommitGraph(path) as graph:
+        count = graph.count
+        added = {}
+        for sha, tree, parent, timestamp in commits:
+            if sha in added or graph.position(sha) is not None:
+                continue
+            parent_position, generation = NO_PARENT, 1
+            if parent:
+                if parent in added:
+                    parent_position, generation = added[parent]
+                else:
+                    parent_commit = graph.lookup(parent)
+                    if parent_commit is None:
+                        raise KeyError(f"parent {parent} of {sha} is not in the commit-graph")
+                    parent_position, generation = parent_commit.position, parent_commit.generation
+                generation += 1
+            added[sha] = (count + len(rows), generation)
+            rows.append(ROW.pack(bytes.fromhex(sha), bytes.fromhex(tree), parent_position, generation, timestamp))
+
+    if not rows:
+        return
+    with open(path, "r+b") as f:
+        # Rows first, then the count, so a crash mid-append leaves the old graph intact
+        f.seek(HEADER.size + count * ROW.size)
+        f.write(b"".join(rows))
+        f.truncate()
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, count + len(rows)))
@@ -0,0 +1,108 @@
+import os
+import time
+import zlib
+
+from app import trace
+
+# How hard to compress each object. Interactive writes (add, write-tree,
+# commit) and repacks get their own zlib level, and content that won't
+# compress anyway (archives, media, columnar data) is stored at a cheap
+# level instead of burning CPU for a fraction of a percent. That's decided
+# by file extension, or by compressing a sample of the object at level 1.
+#
+# Config keys in .ctrlz/config.json:
+#   CompressionLevel          interactive writes, zlib level (-1 = zlib's default)
+#   RepackCompressionLevel    repack and gc
+#   IncompressibleLevel       for content judged incompressible (0 = stored)
+#   IncompressibleExtensions  replaces the list below
+DEFAULT_LEVEL = zlib.Z_DEFAULT_COMPRESSION
+DEFAULT_REPACK_LEVEL = 9
+DEFAULT_INCOMPRESSIBLE_LEVEL = 0
+INCOMPRESSIBLE_EXTENSIONS = {
+    ".7z", ".apk", ".avi", ".avif", ".br", ".bz2", ".docx", ".flac", ".gif", ".gz", ".heic", ".jar",
+    ".jpeg", ".jpg", ".lz4", ".mkv", ".mov", ".mp3", ".mp4", ".npz", ".ogg", ".orc", ".parquet",
+    ".png", ".pptx", ".tgz", ".war", ".webm", ".webp", ".whl", ".woff", ".woff2", ".xlsx", ".xz",
+    ".zip", ".zst",
+}
+SAMPLE_BYTES = 64 * 1024
+# Below this the sample costs about as much as compressing the whole thing
+MIN_SAMPLE_BYTES = 4096
+# Compressed/original above this and the content counts as incompressible
+INCOMPRESSIBLE_RATIO = 0.9
+
+
+def format_bytes(n: int) -> str:
+    for unit in ("B", "KB", "MB"):
+        if n < 1024:
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} GB"
+
+
+class CompressionPolicy:
+    def __init__(self, level: int = DEFAULT_LEVEL, repack_level: int = DEFAULT_REPACK_LEVEL,
+                 incompressible_level: int = DEFAULT_INCOMPRESSIBLE_LEVEL, extensions=INCOMPRESSIBLE_EXTENSIONS):
+        self.level = level
+        self.repack_level = repack_level
+        self.incompressible_level = incompressible_level
+        self.extensions = {ext.lower() if ext.startswith(".") else "." + ext.lower() for ext in extensions}
+        # Totals for this run
+        self.objects = 0
+        self.incompressible = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.seconds = 0.0
+        # If a list, every record() is appended to it as well, for a pool
+        # worker to hand back to the parent
+        self.log = None
+
+    @classmethod
+    def from_config(cls, config: dict):
+        return cls(config.get("CompressionLevel", DEFAULT_LEVEL),
+                   config.get("RepackCompressionLevel", DEFAULT_REPACK_LEVEL),
+                   config.get("IncompressibleLevel", DEFAULT_INCOMPRESSIBLE_LEVEL),
+                   config.get("IncompressibleExtensions", INCOMPRESSIBLE_EXTENSIONS))
+
+    def is_incompressible(self, sample: bytes, name: str = None) -> bool:
+        if name and os.path.splitext(name)[1].lower() in self.extensions:
+            return True
+        if len(sample) < MIN_SAMPLE_BYTES:
+            return False
+        sample = sample[:SAMPLE_BYTES]
+        return len(zlib.compress(sample, 1)) > len(sample) * INCOMPRESSIBLE_RATIO
+
+    def level_for(self, sample: bytes, name: str = None):
+        # (zlib level, judged incompressible) for an interactive write;
+        # sample: the start of the object's content (no header)
+        if self.is_incompressible(sample, name):
+            return self.incompressible_level, True
+        return self.level, False
+
+    def compress(self, data: bytes, level: int, incompressible: bool = False) -> bytes:
+        started = time.perf_counter()
+        compressed = zlib.compress(data, level)
+        self.record(len(data), len(compressed), time.perf_counter() - started, incompressible)
+        return compressed
+
+    def record(self, raw_bytes: int, stored_bytes: int, seconds: float, incompressible: bool = False):
+        # One object actually written
+        if self.log is not None:
+            self.log.append((raw_bytes, stored_bytes, seconds, incompressible))
+        self.objects += 1
+        if incompressible:
+            self.incompressible += 1
+            trace.count("ObjectsStoredIncompressible")
+        self.raw_bytes += raw_bytes
+        self.stored_bytes += stored_bytes
+        self.seconds += seconds
+
+    def summary(self):
+        # One line for the end of a command, or None if nothing was compressed
+        if not self.objects:
+            return None
+        ratio = self.stored_bytes / self.raw_bytes if self.raw_bytes else 1.0
+        line = (f"Compressed {self.objects} objects: {format_bytes(self.raw_bytes)} -> "
+                f"{format_bytes(self.stored_bytes)} ({ratio:.1%}) in {self.seconds:.2f}s")
+        if self.incompressible:
+            line += f", {self.incompressible} stored as incompressible"
+        return line
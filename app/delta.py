@@ -0,0 +1,105 @@
+# Copy/insert deltas between two versions of an object.
+#
+# A delta is: varint base size, varint result size, then ops:
+#   0x00 <varint length> <bytes>        insert literal bytes
+#   0x01 <varint offset> <varint size>  copy a run of the base
+# Matching is anchored on lines, which is what the big generated text files
+# we version are made of, and lets each match be extended with one C-level
+# startswith() instead of a byte-at-a-time loop.
+
+INSERT = 0
+COPY = 1
+MIN_COPY = 8
+
+
+def encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def decode_varint(data, offset: int):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+def make_delta(base: bytes, target: bytes) -> bytes:
+    index = {}
+    pos = 0
+    for line in base.splitlines(keepends=True):
+        index.setdefault(line, pos)
+        pos += len(line)
+
+    out = [encode_varint(len(base)), encode_varint(len(target))]
+    pending = []
+
+    def flush_insert():
+        if pending:
+            literal = b"".join(pending)
+            out.append(bytes([INSERT]) + encode_varint(len(literal)) + literal)
+            pending.clear()
+
+    lines = target.splitlines(keepends=True)
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        start = index.get(line)
+        if start is None:
+            pending.append(line)
+            i += 1
+            continue
+        # Extend the copy for as long as the following lines keep matching
+        first = i
+        size = len(line)
+        i += 1
+        while i < len(lines) and base.startswith(lines[i], start + size):
+            size += len(lines[i])
+            i += 1
+        if size < MIN_COPY:
+            # Not worth a copy op; a short run like "\n" is cheaper inline
+            pending.extend(lines[first:i])
+            continue
+        flush_insert()
+        out.append(bytes([COPY]) + encode_varint(start) + encode_varint(size))
+    flush_insert()
+    return b"".join(out)
+
+
+def apply_delta(base: bytes, delta: bytes) -> bytes:
+    base_size, offset = decode_varint(delta, 0)
+    result_size, offset = decode_varint(delta, offset)
+    if base_size != len(base):
+        raise ValueError("Delta does not apply to this base")
+
+    out = []
+    while offset < len(delta):
+        op = delta[offset]
+        offset += 1
+        if op == COPY:
+            start, offset = decode_varint(delta, offset)
+            size, offset = decode_varint(delta, offset)
+            out.append(base[start:start + size])
+        elif op == INSERT:
+            size, offset = decode_varint(delta, offset)
+            out.append(delta[offset:offset + size])
+            offset += size
+        else:
+            raise ValueError(f"Bad delta op {op}")
+
+    result = b"".join(out)
+    if len(result) != result_size:
+        raise ValueError("Delta produced the wrong size")
+    return result
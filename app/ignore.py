@@ -0,0 +1,117 @@
+import os
+import re
+
+IGNORE_FILE = ".ctrlzignore"
+
+# .ctrlzignore follows gitignore rules:
+#   - a pattern with a slash anywhere but the end is anchored at the repo
+#     root ("/build", "docs/*.html"); otherwise it matches a name at any depth
+#   - a trailing slash only matches directories ("node_modules/")
+#   - "*" and "?" stop at slashes, "**" spans them
+#   - "!" re-includes what an earlier rule excluded; the last match wins
+# Consecutive rules with the same sign are compiled into one alternation, so
+# a path costs one regex match per run of rules rather than per rule.
+
+
+def translate(pattern: str) -> str:
+    out = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            if pattern.startswith("**/", i):
+                out.append("(?:.*/)?")
+                i += 3
+                continue
+            if pattern.startswith("**", i):
+                out.append(".*")
+                i += 2
+                continue
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            end = pattern.find("]", i + 2)
+            if end == -1:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1:end].replace("\\", "\\\\")
+                if body[0] in "!^":
+                    body = "^" + body[1:]
+                out.append(f"(?!/)[{body}]")
+                i = end + 1
+                continue
+        elif c == "\\" and i + 1 < n:
+            out.append(re.escape(pattern[i + 1]))
+            i += 2
+            continue
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
+
+
+def parse_rule(line: str):
+    # (negated, dir_only, regex) or None for blanks and comments
+    line = line.rstrip("\n")
+    if not line.endswith("\\ "):
+        line = line.rstrip()
+    if not line or line.startswith("#"):
+        return None
+    negated = line.startswith("!")
+    if negated:
+        line = line[1:]
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+    if "/" in line:
+        regex = translate(line.lstrip("/"))
+    else:
+        regex = "(?:.*/)?" + translate(line)
+    return negated, dir_only, regex
+
+
+def compile_runs(rules):
+    runs = []
+    for negated, _, regex in rules:
+        if runs and runs[-1][0] == negated:
+            runs[-1][1].append(regex)
+        else:
+            runs.append((negated, [regex]))
+    return [(negated, re.compile("(?:" + "|".join(regexes) + ")\\Z")) for negated, regexes in reversed(runs)]
+
+
+class IgnoreRules:
+    def __init__(self, lines=()):
+        rules = [rule for rule in map(parse_rule, lines) if rule is not None]
+        self._file_runs = compile_runs([rule for rule in rules if not rule[1]])
+        self._dir_runs = compile_runs(rules)
+
+    def __bool__(self):
+        return bool(self._dir_runs)
+
+    def ignored(self, path: str, is_dir: bool = False) -> bool:
+        # path is relative to the repo root, "/"-separated. Callers walk top
+        # down and never descend into an ignored directory, so a path's
+        # parents don't need checking here.
+        for negated, regex in self._dir_runs if is_dir else self._file_runs:
+            if regex.match(path):
+                return not negated
+        return False
+
+    def ignored_path(self, path: str, is_dir: bool = False) -> bool:
+        # Same, for a path that didn't come out of a top-down walk
+        parts = path.split("/")
+        for i in range(1, len(parts)):
+            if self.ignored("/".join(parts[:i]), True):
+                return True
+        return self.ignored(path, is_dir)
+
+
+def load_ignore_rules(path: str = IGNORE_FILE) -> IgnoreRules:
+    if not os.path.exists(path):
+        return IgnoreRules()
+    with open(path, "r") as f:
+        return IgnoreRules(f)
@@ -0,0 +1,145 @@
+import os
+import mmap
+import struct
+from typing import NamedTuple
+
+INDEX_PATH = ".ctrlz/index"
+
+# Layout: header, then a fixed-width entry table sorted by path, then the
+# path bytes the entries point into. Fixed-width rows let us binary search
+# straight out of the mmap without parsing the whole file.
+MAGIC = b"CZIX"
+VERSION = 1
+HEADER = struct.Struct(">4sII")                # magic, version, entry count
+ENTRY = struct.Struct(">IIIQQQQ20s")           # path offset, path length, mode, size, mtime_ns, ctime_ns, inode, sha
+
+
+class IndexEntry(NamedTuple):
+    path: str
+    mode: int
+    size: int
+    mtime_ns: int
+    ctime_ns: int
+    ino: int
+    sha: str
+
+
+def entry_from_stat(path: str, st: os.stat_result, sha: str, mode: int = 0o100644) -> IndexEntry:
+    return IndexEntry(path, mode, st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino, sha)
+
+
+class Index:
+    def __init__(self, path: str = INDEX_PATH):
+        self.path = path
+        self.count = 0
+        self.mtime_ns = 0
+        self._file = None
+        self._map = None
+
+        if not os.path.exists(path):
+            return
+        st = os.stat(path)
+        self.mtime_ns = st.st_mtime_ns
+        if st.st_size < HEADER.size:
+            return
+
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            # Old text index (or something we don't understand): start fresh
+            self.close()
+            return
+        self.count = count
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self._entry(i)
+
+    def _row(self, i):
+        return ENTRY.unpack_from(self._map, HEADER.size + i * ENTRY.size)
+
+    def _path_bytes(self, row):
+        path_off, path_len = row[0], row[1]
+        return self._map[path_off:path_off + path_len]
+
+    def _entry(self, i) -> IndexEntry:
+        row = self._row(i)
+        _, _, mode, size, mtime_ns, ctime_ns, ino, sha = row
+        return IndexEntry(self._path_bytes(row).decode(), mode, size, mtime_ns, ctime_ns, ino, sha.hex())
+
+    def lookup(self, path: str):
+        key = path.encode()
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            candidate = self._path_bytes(self._row(mid))
+            if candidate < key:
+                lo = mid + 1
+            elif candidate > key:
+                hi = mid
+            else:
+                return self._entry(mid)
+        return None
+
+    def iter_prefix(self, prefix: str):
+        # Entries whose path starts with prefix, e.g. everything under "dir/"
+        key = prefix.encode()
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._path_bytes(self._row(mid)) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        for i in range(lo, self.count):
+            if not self._path_bytes(self._row(i)).startswith(key):
+                return
+            yield self._entry(i)
+
+    def is_fresh(self, entry: IndexEntry, st: os.stat_result) -> bool:
+        if (entry.size != st.st_size or entry.mtime_ns != st.st_mtime_ns
+                or entry.ctime_ns != st.st_ctime_ns or entry.ino != st.st_ino):
+            return False
+        # A file touched in the same tick the index was written could have
+        # changed without its stat data changing, so don't trust it.
+        return entry.mtime_ns < self.mtime_ns
+
+
+def write_index(entries, path: str = INDEX_PATH):
+    entries = sorted(entries, key=lambda e: e.path.encode())
+    table_size = HEADER.size + len(entries) * ENTRY.size
+
+    rows = []
+    paths = []
+    offset = table_size
+    for e in entries:
+        encoded = e.path.encode()
+        rows.append(ENTRY.pack(offset, len(encoded), e.mode, e.size, e.mtime_ns,
+                               e.ctime_ns, e.ino, bytes.fromhex(e.sha)))
+        paths.append(encoded)
+        offset += len(encoded)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(entries)))
+        f.write(b"".join(rows))
+        f.write(b"".join(paths))
+    os.replace(tmp_path, path)
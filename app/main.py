@@ -1,393 +1,1462 @@
 import sys
 import os
+import stat
 import zlib
 import hashlib
-import datetime 
-from colorama import init, Fore, Style
-import requests
-import json
-import concurrent.futures
-import fnmatch
+import tempfile
+from contextlib import contextmanager
+# requests, colorama, json, datetime, concurrent.futures and the network and
+# watcher modules are imported by the commands that need them, so local
+# commands start fast
+from app import trace
+from app.color import Fore, Style
+from app.compression import SAMPLE_BYTES, CompressionPolicy
+from app.ignore import load_ignore_rules
+from app.index import Index, entry_from_stat, write_index
+from app.pack import fsync_dir, write_pack
+from app.objects import DELTA_MAX_BYTES, Commit, Manifest, ObjectStore, Tree, parse_tree
+from app.delta import make_delta
+from app.chunking import DEFAULT_AVERAGE, Chunker, format_manifest
+from app.transaction import LOOSE_OBJECT_LIMIT, ObjectTransaction
+from app.commit_graph import GRAPH_PATH, CommitGraph, append_commits
+from app.worktree import MODE_EXECUTABLE, MODE_FILE, MODE_SYMLINK, MODE_TREE, file_mode, walk
+
+object_store = ObjectStore()
+_compression = None
+_transaction = None
+_chunker = None
+_chunk_threshold = None
+_fsync = None
+
+def compression_policy():
+    global _compression
+    if _compression is None:
+        _compression = CompressionPolicy.from_config(load_config())
+    return _compression
+
+def print_compression_summary():
+    line = compression_policy().summary()
+    if line:
+        print(Style.DIM + line)
+
+def chunker():
+    global _chunker
+    if _chunker is None:
+        _chunker = Chunker(load_config().get("ChunkAverageSize", DEFAULT_AVERAGE))
+    return _chunker
+
+def is_chunked_size(size: int) -> bool:
+    # Whether a file this big is stored as chunks behind a manifest
+    global _chunk_threshold
+    if _chunk_threshold is None:
+        _chunk_threshold = load_config().get("ChunkedBlobThreshold") or 0
+    return bool(_chunk_threshold) and size >= _chunk_threshold
+
+def fsync_objects():
+    global _fsync
+    if _fsync is None:
+        _fsync = load_config().get("FsyncObjects", True)
+    return _fsync
+
+@contextmanager
+def object_transaction():
+    # Objects written inside are published together on the way out (see
+    # app/transaction.py); a nested one joins the outer transaction
+    global _transaction
+    if _transaction is not None:
+        yield _transaction
+        return
+    transaction = ObjectTransaction(object_store.objects_dir,
+                                    load_config().get("LooseObjectLimit", LOOSE_OBJECT_LIMIT), fsync_objects())
+    _transaction = transaction
+    try:
+        yield transaction
+    except BaseException:
+        transaction.abort()
+        raise
+    finally:
+        _transaction = None
+    if transaction.commit() is not None:
+        object_store.reload_packs()
+
+def write_object(sha, stored):
+    with object_transaction() as transaction:
+        transaction.add(sha, stored)
+
+def has_object(sha):
+    # Already stored, or waiting in this command's transaction
+    return (_transaction is not None and sha in _transaction) or object_store.freshen(sha)
 
 def main():
-    init(autoreset=True)  
-    
+    if "--trace-perf" in sys.argv:
+        sys.argv.remove("--trace-perf")
     command = sys.argv[1]
-    if command == "init":
-        try:
-            os.mkdir(".ctrlz")
-            os.mkdir(".ctrlz/objects")
-            os.mkdir(".ctrlz/refs")
-            with open(".ctrlz/HEAD", "w") as f:
-                f.write("ref: refs/heads/main\n")
-            print(Fore.GREEN + Style.BRIGHT + "Initialized ctrlz directory")
-        except Exception as e:
-            print(Fore.RED + Style.BRIGHT + f"Error during init: {e}", file=sys.stderr)
-            sys.exit(1)
-
-    elif command == "cat-file":
-        try:
-            hash = sys.argv[3]
-            if not os.path.exists(f".ctrlz/objects/{hash[:2]}/{hash[2:]}"):
-                print(Fore.RED + Style.BRIGHT + f"Object {hash} not found", file=sys.stderr)
-                sys.exit(1)
-            with open(f'.ctrlz/objects/{hash[:2]}/{hash[2:]}', 'rb') as f:
-                content = f.read()
-                decompressed = zlib.decompress(content)
-                _, obj_content = decompressed.split(b'\x00', 1)
-                print(Fore.CYAN + obj_content.decode('utf-8'), end="")
-        except Exception as e:
-            print(Fore.RED + Style.BRIGHT + f"Error during cat-file: {e}", file=sys.stderr)
-            sys.exit(1)
-
-    elif command == "hash-object":
-        try:
-            file_path = sys.argv[3]
-            if file_path:
-                hash = hash_object(file_path)
-                print(Fore.MAGENTA + Style.BRIGHT + hash)
-        except Exception as e:
-            print(Fore.RED + Style.BRIGHT + f"Error during hash-object: {e}", file=sys.stderr)
-            sys.exit(1)
+    handler = COMMANDS.get(command)
+    if handler is None:
+        print(Fore.RED + Style.BRIGHT + f"Unknown command #{command}", file=sys.stderr)
+        raise RuntimeError(f"Unknown command #{command}")
+    try:
+        with trace.phase(command):
+            handler()
+            if command in AUTO_GC_COMMANDS:
+                maybe_auto_gc()
+    except Exception as e:
+        print(Fore.RED + Style.BRIGHT + f"Error during {command}: {e}", file=sys.stderr)
+        sys.exit(1)
 
-    elif command == "ls-tree":
-        try:
-            if sys.argv[2] != '--name-only':
-                print(Fore.RED + Style.BRIGHT + "Only --name-only option is supported for ls-tree", file=sys.stderr)
-                raise RuntimeError("Only --name-only option is supported for ls-tree")
-            ls_tree(sys.argv[3])
-        except Exception as e:
-            print(Fore.RED + Style.BRIGHT + f"Error during ls-tree: {e}", file=sys.stderr)
+def cmd_init():
+    os.mkdir(".ctrlz")
+    os.mkdir(".ctrlz/objects")
+    os.mkdir(".ctrlz/refs")
+    with open(".ctrlz/HEAD", "w") as f:
+        f.write("ref: refs/heads/main\n")
+    print(Fore.GREEN + Style.BRIGHT + "Initialized ctrlz directory")
+
+def cmd_cat_file():
+    if "--batch" in sys.argv or "--batch-check" in sys.argv:
+        cat_file_batch(contents="--batch" in sys.argv, buffered="--buffer" in sys.argv)
+        return
+    option = sys.argv[2]
+    hash = sys.argv[3]
+    if option in ("-t", "-s"):
+        header = object_store.read_header(hash)
+        if header is None:
+            print(Fore.RED + Style.BRIGHT + f"Object {hash} not found", file=sys.stderr)
             sys.exit(1)
+        print(header[0] if option == "-t" else header[1])
+        return
+    opened = object_store.open_raw(hash)
+    if opened is None:
+        print(Fore.RED + Style.BRIGHT + f"Object {hash} not found", file=sys.stderr)
+        sys.exit(1)
+    obj_type, _, chunks = opened
+    if obj_type == "manifest":
+        # A chunked file comes out whole, a chunk at a time
+        _, chunks = object_store.open_blob(hash)
+        obj_type = "blob"
+    if obj_type == "blob":
+        # Blobs go out byte for byte, binary or not
+        out = sys.stdout.buffer
+        for chunk in chunks:
+            out.write(chunk)
+        out.flush()
+    elif obj_type == "tree":
+        for entry in parse_tree(b"".join(chunks)):
+            kind = "tree" if entry.mode == "40000" else "blob"
+            print(Fore.CYAN + f"{int(entry.mode):06d} {kind} {entry.sha}\t{entry.name}")
+    else:
+        print(Fore.CYAN + b"".join(chunks).decode("utf-8", errors="replace"), end="")
+
+def cmd_hash_object():
+    file_path = sys.argv[3]
+    if file_path:
+        hash = hash_object(file_path)
+        print(Fore.MAGENTA + Style.BRIGHT + hash)
+
+def cmd_ls_tree():
+    if sys.argv[2] != '--name-only':
+        print(Fore.RED + Style.BRIGHT + "Only --name-only option is supported for ls-tree", file=sys.stderr)
+        raise RuntimeError("Only --name-only option is supported for ls-tree")
+    ls_tree(sys.argv[3])
+
+def cmd_write_tree():
+    jobs = load_config().get("WriteTreeJobs", 1)
+    if "--jobs" in sys.argv:
+        jobs = int(sys.argv[sys.argv.index("--jobs") + 1])
+    write_tree(jobs=jobs or os.cpu_count())
+    print_compression_summary()
+
+def cmd_commit_tree():
+    len_of_args = len(sys.argv)
+
+    tree_hash = sys.argv[3]
+    message = "blank commit message"
+    parent = None
+    if len_of_args >= 5:
+        if sys.argv[4] == '-m':
+            message = sys.argv[5]
+    if len_of_args >= 8:
+        if sys.argv[6] == '-p':
+            parent = sys.argv[7]
+
+    commit_hash = commit_tree(tree_hash, message, parent if parent else None)
+    print(Fore.MAGENTA + Style.BRIGHT + commit_hash)
+
+def cmd_add():
+    if len(sys.argv) > 3:
+        file_name = sys.argv[3]
+        add(file_name)
+        print_compression_summary()
+    elif len(sys.argv) == 3 and sys.argv[2] == ".":
+        add(".")
+        print_compression_summary()
+    else:
+        print(Fore.RED + Style.BRIGHT + "Usage: ctrlz add <file_name> or ctrlz add .", file=sys.stderr)
+        raise RuntimeError("Usage: ctrlz add <file_name> or ctrlz add .")
 
-    elif command == "write-tree":
-        try:
-            write_tree()
-        except Exception as e:
-            print(Fore.RED + Style.BRIGHT + f"Error during write-tree: {e}", file=sys.stderr)
-            sys.exit(1)
+def cmd_commit():
+    message = sys.argv[3]
+    commit_f(message=message)
 
-    elif command == "commit-tree":
-        try:
-            len_of_args = len(sys.argv)
-
-            tree_hash = sys.argv[3]
-            message = "blank commit message"
-            parent = None
-            if len_of_args >= 5:
-                if sys.argv[4] == '-m':
-                    message = sys.argv[5]
-            if len_of_args >= 8:
-                if sys.argv[6] == '-p':
-                    parent = sys.argv[7]
-
-            commit_hash = commit_tree(tree_hash, message, parent if parent else None)
-            print(Fore.MAGENTA + Style.BRIGHT + commit_hash)
-        except Exception as e:
-            print(Fore.RED + Style.BRIGHT + f"Error during commit-tree: {e}", file=sys.stderr)
-            sys.exit(1)
+def cmd_status():
+    status(porcelain="--porcelain" in sys.argv)
 
-    elif command == "add":
-        try:
-            if len(sys.argv) > 3:
-                file_name = sys.argv[3]
-                add(file_name)
-            elif len(sys.argv) == 3 and sys.argv[2] == ".":
-                add(".")
-            else:
-                print(Fore.RED + Style.BRIGHT + "Usage: ctrlz add <file_name> or ctrlz add .", file=sys.stderr)
-                raise RuntimeError("Usage: ctrlz add <file_name> or ctrlz add .")
-        except Exception as e:
-            print(Fore.RED + Style.BRIGHT + f"Error during add: {e}", file=sys.stderr)
-            sys.exit(1)
-
-    elif command == "commit":
-        try:
-            message = sys.argv[3]
-            commit_f(message=message)
+def cmd_watch():
+    from app.watch import run_watcher, stop_watcher
+    if "--stop" in sys.argv:
+        if stop_watcher():
+            print(Fore.GREEN + Style.BRIGHT + "✔ Watcher stopped")
+        else:
+            print(Fore.YELLOW + "No watcher is running")
+    else:
+        run_watcher()
+
+def cmd_repack():
+    config = load_config()
+    window = config.get("DeltaWindow", 10)
+    depth = config.get("DeltaDepth", 10)
+    if "--window" in sys.argv:
+        window = int(sys.argv[sys.argv.index("--window") + 1])
+    if "--depth" in sys.argv:
+        depth = int(sys.argv[sys.argv.index("--depth") + 1])
+    lock = acquire_gc_lock()
+    if lock is None:
+        print(Fore.RED + Style.BRIGHT + "Another gc or repack is running", file=sys.stderr)
+        sys.exit(1)
+    with lock:
+        repack("-a" in sys.argv or "--all" in sys.argv, window, depth)
+    print_compression_summary()
+
+def cmd_gc():
+    config = load_config()
+    grace = config.get("GcGracePeriod", GC_GRACE_PERIOD)
+    if "--grace" in sys.argv:
+        grace = int(sys.argv[sys.argv.index("--grace") + 1])
+    if "--auto" in sys.argv:
+        maybe_auto_gc()
+        return
+    gc(grace, config.get("DeltaWindow", 10), config.get("DeltaDepth", 10))
+    print_compression_summary()
+
+def cmd_ls_commits():
+    ls_commit()
+
+def cmd_checkout():
+    hash = sys.argv[2] 
+    jobs = load_config().get("CheckoutWorkers")
+    if "--jobs" in sys.argv:
+        jobs = int(sys.argv[sys.argv.index("--jobs") + 1])
+    # 0 (or unset) leaves the pool size to the executor
+    checkout(hash, force="--force" in sys.argv, jobs=max(1, jobs) if jobs else None)
+
+def cmd_set_repo_info():
+    import json
+    username = sys.argv[2]
+    repoName = sys.argv[3]
+
+    file_dir = f".ctrlz/config.json"
+
+    # Keep any other settings already in the config
+    payload = load_config()
+    payload.update({"UserName": username, "RepoName": repoName})
+
+    with open(file_dir, "w") as file:
+        json.dump(payload, file)
+
+    print("Successfully set repo info")
+
+def cmd_push():
+    import json
+    import requests
+    from app.transport import PushJournal, Transport
+    # 1. Load Config
+    file_dir = ".ctrlz/config.json"
+    if not os.path.exists(file_dir):
+        print(Fore.RED + "Please run 'ctrlz setRepoInfo <user> <repo>' first.")
+        sys.exit(1)
 
-        except Exception as e:
-            print(Fore.RED + Style.BRIGHT + f"Error during commit: {e}", file=sys.stderr)
-            sys.exit(1)
+    with open(file_dir, 'r') as file:
+        data = json.load(file)
+    username = data["UserName"]
+    reponame = data["RepoName"]
+    concurrency = data.get("PushConcurrency", 4)
+    if "--jobs" in sys.argv:
+        concurrency = int(sys.argv[sys.argv.index("--jobs") + 1])
+    transport = Transport(remote_url(), username, reponame, concurrency=concurrency)
+
+    # 2. Get Remote State
+    response = transport.get_ref("main")
+    if response.status_code == 200:
+        remote_hash = response.text.strip()
+    else:
+        remote_hash = None 
 
-    elif command == "status":
-        try:
-            status()
-        except Exception as e:
-            print(Fore.RED + Style.BRIGHT + f"Error during status: {e}", file=sys.stderr)
-            sys.exit(1)
+    # 3. Get Local State
+    local_hash_location = ".ctrlz/refs/heads/main"
+    with open(local_hash_location, "r") as file:
+        local_hash = file.read().strip()
 
-    elif command == "ls-commits":
-        try:
-            ls_commit()
-        except Exception as e:
-            print(Fore.RED + Style.BRIGHT + f"Error during ls-commits: {e}", file=sys.stderr)
-            sys.exit(1)
+    # 4. Find Missing Commits (straight from the commit-graph, no object reads)
+    commits_to_upload = []
+    commit_trees = {}
+    parent_trees = {}
 
-    elif command == "checkout":
-        try:
-            hash = sys.argv[2] 
-            checkout(hash)
-        except Exception as e:
-            print(Fore.RED + Style.BRIGHT + f"Error during checkout: {e}", file=sys.stderr)
-            sys.exit(1)
+    print(f"Local: {local_hash[:7]} | Remote: {remote_hash[:7] if remote_hash else 'None'}")
 
-    elif command == "setRepoInfo":
-        username = sys.argv[2]
-        repoName = sys.argv[3]
+    add_to_commit_graph(local_hash)
+    with CommitGraph() as graph:
+        for commit in graph.walk(local_hash):
+            if commit.sha == remote_hash:
+                break
+            commits_to_upload.append(commit.sha)
+            commit_trees[commit.sha] = commit.tree
+            parent_trees[commit.sha] = graph[commit.parent].tree if commit.parent is not None else None
+
+    # 5. Find the Trees & Blobs each commit introduces over its parent. The
+    #    remote already has everything its own commit reaches, so unchanged
+    #    subtrees are pruned by hash without being read.
+    candidates = set(commits_to_upload) # Start with the commits themselves
+    previous_blobs = {}
+
+    for commit in commits_to_upload:
+        candidates.update(find_new_objects(parent_trees[commit], commit_trees[commit], previous_blobs))
+
+    # A chunked file's manifest brings its chunks; the ones an earlier
+    # version shares are filtered out with the rest below
+    for obj_hash in list(candidates):
+        if object_store.read_type(obj_hash) == "manifest":
+            candidates.update(sha for sha, _ in object_store.read_manifest(obj_hash).chunks)
+
+    # 6. Skip whatever an interrupted push of this same commit already
+    #    got acknowledged, then ask the server which of the rest it lacks
+    journal = PushJournal(local_hash)
+    candidates -= journal.acked
+    objects_to_upload = negotiate_missing(sorted(candidates), transport)
+
+
+    # A changed blob can go out as a delta against a base the server is
+    # known to have: the base its pack entry uses, else the file's
+    # previous version
+    upload_set = set(objects_to_upload)
+    on_server = (candidates | journal.acked | set(previous_blobs.values())) - upload_set
+    delta_bases = {}
+    for obj_hash in objects_to_upload:
+        base = object_store.delta_base(obj_hash)
+        if base not in on_server:
+            base = previous_blobs.get(obj_hash)
+        if base in on_server:
+            delta_bases[obj_hash] = base
+
+    print(Fore.YELLOW + f"Pushing {len(objects_to_upload)} objects ({len(candidates) - len(objects_to_upload)} already on the server, {len(delta_bases)} with a delta base there)...")
+    print(f"Object cache: {object_store.hits} hits, {object_store.misses} misses")
+
+    # 7. Upload Everything, several batches in flight
+    try:
+        upload_batch(objects_to_upload, transport, journal, delta_bases)
+    except (requests.ConnectionError, requests.Timeout) as e:
+        print(Fore.RED + f"Push interrupted: {e}")
+        print(Fore.YELLOW + "Run push again to resume where it stopped.")
+        sys.exit(1)
 
-        file_dir = f".ctrlz/config.json"
+    # 8. Update Ref
+    response = transport.update_ref("main", local_hash)
+    if response.status_code != 200:
+        print(Fore.RED + f"Updating the remote ref failed: {response.status_code}")
+        print(response.text)
+        sys.exit(1)
+    journal.finish()
+    transport.close()
 
-        payload = {"UserName": username, "RepoName": repoName}
+    print(Fore.GREEN + "Push complete!")
 
-        with open(file_dir, "w") as file:
-            json.dump(payload, file)
-        
-        print("Successfully set repo info")
+def cmd_fetch():
+    if not os.path.exists(".ctrlz/config.json"):
+        print(Fore.RED + "Please run 'ctrlz setRepoInfo <user> <repo>' first.")
+        sys.exit(1)
+    tip = fetch()
+    if tip is not None:
+        print(f"{REMOTE_REF_PATH}: {tip[:7]} (run 'ctrlz checkout {tip}' to switch to it)")
+
+def cmd_clone():
+    import json
+    # ctrlz clone <user> <repo> [directory] [--url URL]
+    args = sys.argv[2:]
+    url = None
+    if "--url" in args:
+        at = args.index("--url")
+        url = args[at + 1]
+        del args[at:at + 2]
+    username, reponame = args[0], args[1]
+    directory = args[2] if len(args) > 2 else reponame
+    # A clone that was interrupted leaves just .ctrlz behind; carry on with it
+    resuming = (os.path.isdir(directory) and os.listdir(directory) == [".ctrlz"]
+                and not os.path.exists(os.path.join(directory, ".ctrlz/refs/heads/main")))
+    if os.path.exists(directory) and os.listdir(directory) and not resuming:
+        print(Fore.RED + f"Destination {directory} already exists and is not empty.")
+        sys.exit(1)
 
-    elif command == "push":
-        # 1. Load Config
-        file_dir = ".ctrlz/config.json"
-        if not os.path.exists(file_dir):
-            print(Fore.RED + "Please run 'ctrlz setRepoInfo <user> <repo>' first.")
+    os.makedirs(directory, exist_ok=True)
+    os.chdir(directory)
+    if not resuming:
+        cmd_init()
+        os.makedirs(".ctrlz/refs/heads", exist_ok=True)
+    config = load_config()
+    config.update({"UserName": username, "RepoName": reponame})
+    if url:
+        config["RemoteUrl"] = url.rstrip("/")
+    with open(".ctrlz/config.json", "w") as file:
+        json.dump(config, file)
+
+    tip = fetch()
+    if tip is None:
+        print(Fore.YELLOW + "The remote repository is empty.")
+        return
+    checkout(tip)
+
+# Looked up once per run; each command imports what only it needs
+COMMANDS = {
+    "init": cmd_init,
+    "cat-file": cmd_cat_file,
+    "hash-object": cmd_hash_object,
+    "ls-tree": cmd_ls_tree,
+    "write-tree": cmd_write_tree,
+    "commit-tree": cmd_commit_tree,
+    "add": cmd_add,
+    "commit": cmd_commit,
+    "status": cmd_status,
+    "watch": cmd_watch,
+    "repack": cmd_repack,
+    "gc": cmd_gc,
+    "ls-commits": cmd_ls_commits,
+    "checkout": cmd_checkout,
+    "setRepoInfo": cmd_set_repo_info,
+    "push": cmd_push,
+    "fetch": cmd_fetch,
+    "clone": cmd_clone,
+}
+
+@trace.traced
+def negotiate_missing(hashes, transport, batch_size=10000):
+    # Send candidate ids a batch at a time and keep the ones the server lacks.
+    # A server without the endpoint just gets everything.
+    missing = []
+    for i in range(0, len(hashes), batch_size):
+        response = transport.request("POST", transport.url("missing"), json={"Hashes": hashes[i:i + batch_size]})
+        if response.status_code == 404:
+            return hashes
+        if response.status_code != 200:
+            print(Fore.RED + f"Object negotiation failed: {response.status_code}")
+            print(response.text)
             sys.exit(1)
-            
-        with open(file_dir, 'r') as file:
-            data = json.load(file)
-        username = data["UserName"]
-        reponame = data["RepoName"]
-
-        # 2. Get Remote State
-        response = getCurrentRef("main", username, reponame)
-        if response.status_code == 200:
-            remote_hash = response.text.strip()
+        missing.extend(response.json()["Missing"])
+    return missing
+
+@trace.traced
+def find_new_objects(old_tree, new_tree, previous_blobs=None):
+    # Trees and blobs reachable from new_tree but not from old_tree. Subtrees
+    # whose hash matches on both sides are never opened. previous_blobs, if
+    # given, collects {changed blob: the blob it replaced at the same path}.
+    objects = set()
+    if new_tree is None or new_tree == old_tree:
+        return objects
+    objects.add(new_tree)
+    old = {e.name: e for e in object_store.read_tree(old_tree)} if old_tree else {}
+    for entry in object_store.read_tree(new_tree):
+        previous = old.get(entry.name)
+        if previous is not None and previous.sha == entry.sha:
+            continue
+        if entry.mode == "40000":
+            old_sub = previous.sha if previous is not None and previous.mode == "40000" else None
+            objects.update(find_new_objects(old_sub, entry.sha, previous_blobs))
         else:
-            remote_hash = None 
-
-        # 3. Get Local State
-        local_hash_location = ".ctrlz/refs/heads/main"
-        with open(local_hash_location, "r") as file:
-            local_hash = file.read().strip()
-
-        # 4. Find Missing Commits
-        commits_to_upload = []
-        curr = local_hash
-        
-        print(f"Local: {local_hash[:7]} | Remote: {remote_hash[:7] if remote_hash else 'None'}")
-        
-        while curr and curr != remote_hash:
-            commits_to_upload.append(curr)
-            _, parent = read_commit(curr)
-            curr = parent
-
-        # 5. Find ALL Objects (Trees & Blobs) for those commits
-        objects_to_upload = set(commits_to_upload) # Start with the commits themselves
-        
-        for commit in commits_to_upload:
-            tree_hash, _ = read_commit(commit)
-            if tree_hash:
-                # Add the tree itself
-                objects_to_upload.add(tree_hash)
-                # Find everything inside that tree
-                objects_to_upload.update(find_objects_in_tree(tree_hash))
-
-        print(Fore.YELLOW + f"Pushing {len(objects_to_upload)} objects...")
-
-        # 6. Upload Everything
-        # with concurrent.futures.ThreadPoolExecutor(max_workers=50) as executor:
-        #     futures = []
-        #     for obj_hash in objects_to_upload:
-        #         futures.append(executor.submit(upload_worker, obj_hash, username, reponame))
-
-        #     count = 0
-        #     total = len(objects_to_upload)
-        #     for future in concurrent.futures.as_completed(futures):
-        #         print(f"\rProgress: {count}/{total} objects uploaded...", end="")
-            
-        #     print("\n")
-
-        upload_batch(list(objects_to_upload), username, reponame)
-
-        # 7. Update Ref
-        requests.post(
-            f"https://ctrlz.brodie-rogers.com/update-ref/{username}/{reponame}",
-            json={"Ref": "main", "Hash": local_hash}
-        )
-        
-        print(Fore.GREEN + "Push complete!") 
+            objects.add(entry.sha)
+            if previous_blobs is not None and previous is not None and previous.mode != "40000":
+                previous_blobs.setdefault(entry.sha, previous.sha)
+    return objects
 
+@trace.traced
+def upload_batch(hashes, transport, journal, delta_bases=None):
+    import concurrent.futures
+    from app.transfer import FRAME, stream_objects
+    # Objects go out exactly as stored (already compressed), framed with their
+    # id and length, and are streamed from disk a buffer at a time. Batches
+    # are sized so there's enough of them to keep every connection busy.
+    sizes = {}
+    for obj_hash in hashes:
+        size = object_store.stored_size(obj_hash)
+        if size is None:
+            continue
+        if size > 5 * 1024 * 1024:
+            print(f"Found large object: {obj_hash} ({size / 1024 / 1024:.2f} MB compressed)")
+        sizes[obj_hash] = size + FRAME.size
+    if not sizes:
+        return
+    batch_size = min(50 * 1024 * 1024, max(1024 * 1024, sum(sizes.values()) // (transport.concurrency * 2)))
+
+    batches = [[]]
+    batch_bytes = 0
+    for obj_hash, size in sizes.items():
+        if batch_bytes >= batch_size:
+            batches.append([])
+            batch_bytes = 0
+        batches[-1].append(obj_hash)
+        batch_bytes += size
+
+    def send(batch):
+        return transport.request(
+            "POST", transport.url("upload-stream"),
+            body=lambda: stream_objects(object_store, batch, delta_bases),
+            headers={"Content-Type": "application/octet-stream"}
+        )
 
+    # After a failure nothing new is sent, but the batches already in flight
+    # are waited for and journaled if they made it, so the next push skips them
+    legacy = False
+    failed = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=transport.concurrency) as executor:
+        futures = {executor.submit(send, batch): batch for batch in batches}
+        done = 0
+        for future in concurrent.futures.as_completed(futures):
+            if future.cancelled():
+                continue
+            try:
+                response = future.result()
+            except Exception as error:
+                response = error
+            if not isinstance(response, Exception) and response.status_code == 200:
+                journal.record(futures[future])
+                done += 1
+                print(f"\rProgress: {done}/{len(batches)} batches uploaded...", end="")
+            elif not isinstance(response, Exception) and response.status_code == 404:
+                legacy = True
+            elif failed is None:
+                failed = response
+                for pending in futures:
+                    pending.cancel()
+        print()
+
+    if isinstance(failed, Exception):
+        raise failed
+    if failed is not None:
+        print(Fore.RED + f"Batch upload failed: {failed.status_code}")
+        print(failed.text)
+        print(Fore.YELLOW + "Run push again to resume where it stopped.")
+        sys.exit(1)
 
-    else:   
-        print(Fore.RED + Style.BRIGHT + f"Unknown command #{command}", file=sys.stderr)
-        raise RuntimeError(f"Unknown command #{command}")
+    if legacy:
+        upload_batch_legacy([h for h in sizes if h not in journal.acked], transport, journal)
 
-def upload_batch(hashes, username, reponame):
+@trace.traced
+def upload_batch_legacy(hashes, transport, journal):
+    # Decompressed objects back to back, for servers without upload-stream
     batch_data = bytearray()
+    batch_hashes = []
     batch_size = 50 * 1024 * 1024
 
-    for obj_hash in hashes:
-        path = f".ctrlz/objects/{obj_hash[:2]}/{obj_hash[2:]}"
-        if not os.path.exists(path):
-            continue
-
-        with open(path, 'rb') as file:
-            compressed_data = file.read()
-            full_object_data = zlib.decompress(compressed_data)
-
-        if len(full_object_data) > 5 * 1024 * 1024: # If bigger than 10MB
-            print(f"Found large object: {obj_hash} ({len(full_object_data) / 1024 / 1024:.2f} MB)")
+    for i, obj_hash in enumerate(hashes):
+        full_object_data = object_store.read_raw(obj_hash)
+        if full_object_data is not None:
+            batch_data.extend(full_object_data)
+            batch_hashes.append(obj_hash)
 
-        batch_data.extend(full_object_data)
-
-        if len(batch_data) >= batch_size:
+        if len(batch_data) >= batch_size or (i == len(hashes) - 1 and batch_data):
             print(f"Sending batch of {len(batch_data)} bytes...")
-            response = requests.post(
-                f"https://ctrlz.brodie-rogers.com/upload-batch/{username}/{reponame}",
-                data=batch_data
-            )
+            response = transport.request("POST", transport.url("upload-batch"), body=bytes(batch_data))
 
             if response.status_code != 200:
                 print(Fore.RED + f"Batch upload failed: {response.status_code}")
                 print(response.text)
+                print(Fore.YELLOW + "Run push again to resume where it stopped.")
                 sys.exit(1)
 
+            journal.record(batch_hashes)
             batch_data = bytearray()
-        
-    if len(batch_data) > 0:
-        print(f"Sending batch of {len(batch_data)} bytes...")
-        response = requests.post(
-            f"https://ctrlz.brodie-rogers.com/upload-batch/{username}/{reponame}",
-            data=batch_data
-        )
-
+            batch_hashes = []
+
+REMOTE_REF_PATH = ".ctrlz/refs/remotes/origin/main"
+FETCH_BATCH_OBJECTS = 2000
+
+@trace.traced
+def fetch():
+    # Download whatever the remote's main reaches that isn't here yet into a
+    # new pack and point refs/remotes/origin/main at it. Returns the remote
+    # tip, or None if the remote has no main. An interrupted fetch keeps what
+    # it received, so running it again only asks for the rest.
+    import time
+    import requests
+    from app.transport import Transport
+    config = load_config()
+    concurrency = config.get("FetchConcurrency", config.get("PushConcurrency", 4))
+    if "--jobs" in sys.argv:
+        concurrency = int(sys.argv[sys.argv.index("--jobs") + 1])
+    batch_objects = config.get("FetchBatchObjects", FETCH_BATCH_OBJECTS)
+
+    with Transport(remote_url(), config["UserName"], config["RepoName"], concurrency=concurrency) as transport:
+        response = transport.get_ref("main")
+        if response.status_code == 404:
+            return None
         if response.status_code != 200:
-            print(Fore.RED + f"Batch upload failed: {response.status_code}")
+            print(Fore.RED + f"Reading the remote ref failed: {response.status_code}")
             print(response.text)
             sys.exit(1)
+        tip = response.text.strip()
 
+        started = time.perf_counter()
+        try:
+            received, received_bytes = fetch_objects(tip, transport, batch_objects)
+        except (requests.ConnectionError, requests.Timeout, RuntimeError) as e:
+            print()
+            print(Fore.RED + f"Fetch interrupted: {e}")
+            print(Fore.YELLOW + f"Run {sys.argv[1]} again to resume where it stopped.")
+            sys.exit(1)
+        elapsed = time.perf_counter() - started
+
+    add_to_commit_graph(tip)
+    os.makedirs(os.path.dirname(REMOTE_REF_PATH), exist_ok=True)
+    with open(REMOTE_REF_PATH, "w") as f:
+        f.write(tip + "\n")
+    if not received:
+        print(Fore.GREEN + "Already up to date.")
+        return tip
+    rate = received_bytes / elapsed / 1024 / 1024 if elapsed else 0
+    print(Fore.GREEN + f"Received {received} objects ({received_bytes / 1024 / 1024:.2f} MB) in {elapsed:.2f}s, {rate:.1f} MB/s")
+    return tip
+
+def complete_commits():
+    # Commits whose whole history is already here: everything a local ref
+    # reaches. The walk stops at these without looking inside.
+    tips = [head_commit_hash()]
+    if os.path.exists(REMOTE_REF_PATH):
+        with open(REMOTE_REF_PATH) as f:
+            tips.append(f.read().strip())
+    complete = set()
+    with CommitGraph() as graph:
+        for tip in tips:
+            if tip and tip not in complete and graph.position(tip) is not None:
+                complete.update(commit.sha for commit in graph.walk(tip))
+    return complete
+
+@trace.traced
+def fetch_objects(tip, transport, batch_objects=FETCH_BATCH_OBJECTS):
+    # Walk from the remote tip a level at a time. Commits and trees have to
+    # arrive before we know what they point to, so each level's are fetched
+    # together; blobs are leaves and go out in big batches on the pool while
+    # the walk carries on. Everything received is written into one pack.
+    import concurrent.futures
+    import threading
+    from app.pack import PackWriter
+    complete = complete_commits()
+    writer = PackWriter()
+    lock = threading.Lock()
+    totals = {"Objects": 0, "Bytes": 0}
+    seen = set()
+    frontier = [(tip, "commit")]
+    blobs = []
+    blob_futures = []
+
+    def children(obj_type, raw):
+        _, content = raw.split(b"\x00", 1)
+        if obj_type == "commit":
+            commit = Commit(raw)
+            return [(commit.tree, "tree")] + ([(commit.parent, "commit")] if commit.parent else [])
+        if obj_type == "manifest":
+            return [(sha, "blob") for sha, _ in Manifest(content).chunks]
+        return [(entry.sha, "tree" if entry.mode == "40000" else "blob") for entry in parse_tree(content)]
 
-def load_ignore_rules():
-    rules = []
-    if os.path.exists(".ctrlzignore"):
-        with open(".ctrlzignore", "r") as f:
-            for line in f:
-                line = line.strip()
-                if line and not line.startswith("#"):
-                    rules.append(line)
-    return rules
-
-def is_ignored(path, rules):
-    for rule in rules:
-        # Match against the full path or just the filename
-        if fnmatch.fnmatch(path, rule) or fnmatch.fnmatch(os.path.basename(path), rule):
-            return True
-    return False   
-
-def upload_worker(obj_hash, username, reponame):
-    path = f".ctrlz/objects/{obj_hash[:2]}/{obj_hash[2:]}"
-    if not os.path.exists(path):
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=transport.concurrency) as executor:
+            while frontier:
+                wanted = []
+                while frontier:
+                    sha, obj_type = frontier.pop()
+                    if sha in seen or sha in complete:
+                        continue
+                    seen.add(sha)
+                    if sha in writer or object_store.exists(sha):
+                        # Here already (an earlier fetch got this far), but
+                        # what it points to may not be. A file might be a
+                        # manifest, whose chunks count.
+                        if obj_type == "blob" and sha not in writer and object_store.read_type(sha) == "manifest":
+                            obj_type = "manifest"
+                        if obj_type != "blob":
+                            frontier.extend(children(obj_type, object_store.read_raw(sha)))
+                    elif obj_type == "blob":
+                        blobs.append(sha)
+                    else:
+                        wanted.append(sha)
+
+                while len(blobs) >= batch_objects:
+                    batch, blobs[:] = blobs[:batch_objects], blobs[batch_objects:]
+                    blob_futures.append(executor.submit(download_objects, batch, transport, writer, lock, totals))
+
+                # This level's commits and trees, split across the pool
+                step = max(1, -(-len(wanted) // transport.concurrency))
+                futures = [executor.submit(download_objects, wanted[i:i + step], transport, writer, lock, totals, True)
+                           for i in range(0, len(wanted), step)]
+                for future in futures:
+                    for sha, raw in future.result().items():
+                        frontier.extend(children(raw.split(b" ", 1)[0].decode(), raw))
+
+                if not frontier:
+                    # Out of commits and trees: send the last blobs off, then
+                    # follow any manifests among them to their chunks
+                    if blobs:
+                        blob_futures.append(executor.submit(download_objects, blobs, transport, writer, lock, totals))
+                        blobs = []
+                    for future in blob_futures:
+                        for sha, raw in future.result().items():
+                            frontier.extend(children("manifest", raw))
+                    blob_futures = []
+        if totals["Objects"]:
+            print()
+    finally:
+        # Keep whatever arrived, finished or not
+        with lock:
+            writer.finish(sync=fsync_objects())
+        object_store.reload_packs()
+    return totals["Objects"], totals["Bytes"]
+
+@trace.traced
+def download_objects(hashes, transport, writer, lock, totals, keep=False):
+    # One download-stream request for `hashes`, objects written into the pack
+    # as their frames arrive. A connection that drops mid-stream is retried for
+    # just the objects not yet received. Returns {sha: raw object} for what
+    # wasn't a blob (manifests, among blobs), or with keep, for everything.
+    import time
+    import requests
+    from urllib3.exceptions import HTTPError
+    from app.transfer import FULL, read_frames
+    remaining = set(hashes)
+    kept = {}
+    for attempt in range(transport.retries + 1):
+        response = transport.request("POST", transport.url("download-stream"),
+                                     json={"Hashes": sorted(remaining)}, stream=True)
+        if response.status_code != 200:
+            raise RuntimeError(f"Download failed: {response.status_code} {response.text}")
+        try:
+            with response:
+                for sha, kind, length, chunks in read_frames(response.raw):
+                    stored = b"".join(chunks)
+                    if sha not in remaining or kind != FULL:
+                        continue
+                    raw = zlib.decompress(stored)
+                    header, content = raw.split(b"\x00", 1)
+                    actual = hashlib.sha1(content if header.startswith(b"blob ") else raw).hexdigest()
+                    if actual != sha:
+                        raise RuntimeError(f"Object {sha} failed verification")
+                    with lock:
+                        writer.add(sha, stored)
+                        totals["Objects"] += 1
+                        totals["Bytes"] += length
+                        if totals["Objects"] % 100 == 0:
+                            print(f"\rReceiving objects: {totals['Objects']} ({totals['Bytes'] / 1024 / 1024:.2f} MB)", end="")
+                    trace.count("ObjectsReceived")
+                    trace.count("BytesReceived", length)
+                    remaining.discard(sha)
+                    if keep or not header.startswith(b"blob "):
+                        kept[sha] = raw
+            break
+        except (requests.RequestException, HTTPError) as e:
+            if attempt == transport.retries:
+                raise requests.ConnectionError(f"{len(remaining)} objects not received: {e}")
+            time.sleep(transport.backoff * 2 ** attempt)
+    if remaining:
+        raise RuntimeError(f"The remote is missing {len(remaining)} objects, e.g. {min(remaining)}")
+    return kept
+
+@trace.traced
+def repack(everything=False, window=10, depth=10):
+    # Move every loose object (with --all, every object) into one new pack,
+    # storing blobs as deltas against similar blobs where that pays off,
+    # then drop the loose copies and packs it replaces
+    objects_dir = object_store.objects_dir
+    # One listing of each: whatever turns up after it (a concurrent add) is
+    # neither packed nor deleted
+    packs = list(object_store.packs) if everything else []
+    old_packs = [(pack.idx_path, pack.pack_path) for pack in packs]
+    loose = set(object_store.iter_loose_hashes())
+    hashes = list(loose)
+    hashes += {sha for pack in packs for sha in pack} - loose
+
+    if not hashes:
+        print(Fore.GREEN + Style.BRIGHT + "✔ Nothing to pack")
         return
-    
-    with open(path, 'rb') as f:
-        raw_compress = f.read()
-        full_data = zlib.decompress(raw_compress)
 
-    response = requests.post(
-        f"https://ctrlz.brodie-rogers.com/upload/{username}/{reponame}",
-        data=full_data
-    )
+    bases = find_delta_bases(hashes, window, depth) if window > 0 and depth > 0 else {}
 
-    if response.status_code == 200:
-        return f"Uploaded {obj_hash[:7]}"
-    else:
-        return f"Failed {obj_hash[:7]}"
-
-def getCurrentRef(branch, username, reponame):
+    objects = []
+    for obj_hash in hashes:
+        base, delta = bases.get(obj_hash, (None, None))
+        if base is not None:
+            objects.append((obj_hash, delta, base))
+        else:
+            objects.append((obj_hash, pack_stored(obj_hash) if obj_hash in loose else object_store.read_stored(obj_hash), None))
+    before = sum(object_store.stored_size(obj_hash) for obj_hash in hashes)
+    after = sum(len(stored) for _, stored, _ in objects)
+    idx_path = write_pack(objects, sync=fsync_objects())
+    object_store.reload_packs()
+
+    for old_idx, old_pack in old_packs:
+        if old_idx != idx_path:
+            os.remove(old_idx)
+            os.remove(old_pack)
+    for obj_hash in loose:
+        os.remove(f"{objects_dir}/{obj_hash[:2]}/{obj_hash[2:]}")
+        try:
+            os.rmdir(f"{objects_dir}/{obj_hash[:2]}")
+        except OSError:
+            pass
+
+    print(Fore.GREEN + Style.BRIGHT + f"✔ Packed {len(hashes)} objects ({len(bases)} as deltas) into {os.path.basename(idx_path)[:-4]}, {before} -> {after} bytes")
+
+@trace.traced
+def find_delta_bases(hashes, window, depth):
+    # Returns {blob: (base blob, zlib'd delta)}. Blobs are lined up by file
+    # name, biggest first, so successive versions of a file sit next to each
+    # other; each one is tried against the `window` blobs before it.
+    names = {}
+    for obj_hash in hashes:
+        if object_store.read_type(obj_hash) == "tree":
+            for entry in object_store.read_tree(obj_hash):
+                names.setdefault(entry.sha, entry.name)
 
-    response = requests.get(f"https://ctrlz.brodie-rogers.com/refs/{username}/{reponame}/{branch}")
+    blobs = []
+    for obj_hash in hashes:
+        if obj_hash not in names or object_store.stored_size(obj_hash) > DELTA_MAX_BYTES:
+            continue
+        if object_store.read_type(obj_hash) == "blob":
+            # Compare deltas against the full stored size, even for blobs
+            # that are a delta already
+            size = len(object_store.read_stored(obj_hash))
+            blobs.append((names[obj_hash], -size, obj_hash))
+    blobs.sort()
+
+    bases = {}
+    depths = {}
+    recent = []
+    repack_level = compression_policy().repack_level
+    for name, neg_size, obj_hash in blobs:
+        content = object_store.read_raw(obj_hash).split(b"\x00", 1)[1]
+        best = None
+        for base_hash, base_content in recent:
+            if depths.get(base_hash, 0) >= depth:
+                continue
+            delta = zlib.compress(make_delta(base_content, content), repack_level)
+            if len(delta) < -neg_size // 2 and (best is None or len(delta) < len(best[1])):
+                best = (base_hash, delta)
+        if best is not None:
+            bases[obj_hash] = best
+            depths[obj_hash] = depths.get(best[0], 0) + 1
+        recent.append((obj_hash, content))
+        if len(recent) > window:
+            recent.pop(0)
+    return bases
+
+GC_LOCK_PATH = ".ctrlz/gc.lock"
+GC_GRACE_PERIOD = 14 * 24 * 3600
+GC_AUTO_LOOSE = 6700
+GC_AUTO_PACKS = 50
+# Commands that write loose objects and so may trigger an automatic gc
+AUTO_GC_COMMANDS = {"add", "commit", "write-tree"}
+
+def acquire_gc_lock():
+    # An open, flock'ed lock file, or None if another gc/repack holds it. The
+    # lock goes away with the process, so a crashed gc never wedges the repo.
+    import fcntl
+    lock = open(GC_LOCK_PATH, "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
+
+def maybe_auto_gc():
+    # Like git, estimate the loose object count from one fanout directory.
+    # Big adds and fetches write packs instead, so too many of those
+    # (each one another index to search) triggers it too.
+    try:
+        sample = sum(1 for name in os.listdir(f"{object_store.objects_dir}/17") if not name.startswith("tmp_"))
+    except FileNotFoundError:
+        sample = 0
+    try:
+        packs = sum(1 for name in os.listdir(f"{object_store.objects_dir}/pack") if name.endswith(".idx"))
+    except FileNotFoundError:
+        packs = 0
+    if not sample and packs <= 1:
+        return
+    config = load_config()
+    loose_limit = config.get("GcAutoLoose", GC_AUTO_LOOSE)
+    pack_limit = config.get("GcAutoPacks", GC_AUTO_PACKS)
+    if loose_limit and sample * 256 > loose_limit:
+        print(Fore.YELLOW + f"Auto packing the repository (about {sample * 256} loose objects)...")
+    elif pack_limit and packs > pack_limit:
+        print(Fore.YELLOW + f"Auto packing the repository ({packs} packs)...")
+    else:
+        return
+    gc(config.get("GcGracePeriod", GC_GRACE_PERIOD), config.get("DeltaWindow", 10), config.get("DeltaDepth", 10))
+
+def gc_roots():
+    # Refs, HEAD, every commit ls-commits knows about (a checkout can move the
+    # branch back past commits we still list), and everything staged
+    roots = set()
+    paths = [".ctrlz/HEAD"]
+    for dir_path, _, names in os.walk(".ctrlz/refs"):
+        paths.extend(os.path.join(dir_path, name) for name in names)
+    for path in paths:
+        with open(path, "r") as f:
+            value = f.read().strip()
+        if len(value) == 40:
+            roots.add(value)
+    if os.path.exists(GRAPH_PATH):
+        with CommitGraph() as graph:
+            roots.update(commit.sha for commit in graph)
+    with Index() as index:
+        roots.update(entry.sha for entry in index)
+    return roots
+
+@trace.traced
+def mark_reachable(roots):
+    # Every object reachable from roots. Blobs are never inflated past their
+    # header; a missing object is simply not followed.
+    reachable = set()
+    pending = list(roots)
+    while pending:
+        sha = pending.pop()
+        if sha in reachable:
+            continue
+        obj_type = object_store.read_type(sha)
+        if obj_type is None:
+            continue
+        reachable.add(sha)
+        if obj_type == "blob":
+            continue
+        obj = object_store.read(sha)
+        if isinstance(obj, Commit):
+            pending.append(obj.tree)
+            if obj.parent:
+                pending.append(obj.parent)
+        elif isinstance(obj, Tree):
+            # Files get the type check too: a manifest keeps its chunks
+            pending.extend(entry.sha for entry in obj)
+        elif isinstance(obj, Manifest):
+            reachable.update(sha for sha, _ in obj.chunks)
+    return reachable
+
+@trace.traced
+def gc(grace=GC_GRACE_PERIOD, window=10, depth=10):
+    # Pack everything reachable into one pack and delete the rest once it's
+    # older than the grace period. Safe next to other commands:
+    #   - only one gc/repack runs at a time (GC_LOCK_PATH)
+    #   - loose objects modified within the grace period, and anything they
+    #     point at, are left alone; writers freshen the mtime of objects they
+    #     reuse (the pack's, if packed), so an add or commit in flight never
+    #     loses an object
+    #   - unreachable objects from a pack modified within the grace period
+    #     are written back loose with the pack's mtime, to age out from there
+    #   - only what was listed up front is deleted, after the new pack is in
+    #     place, and mtimes are checked again right before each delete
+    #   - readers that miss a loose object reload the pack list and retry
+    import time
+    started = time.perf_counter()
+    lock = acquire_gc_lock()
+    if lock is None:
+        print(Fore.YELLOW + "Another gc or repack is running, skipping")
+        return
+    with lock:
+        objects_dir = object_store.objects_dir
+        cutoff = time.time_ns() - grace * 1_000_000_000
 
-    return response
+        # 1. Snapshot the store
+        loose = {}
+        stale_temps = []
+        for subdir in os.listdir(objects_dir):
+            subdir_path = os.path.join(objects_dir, subdir)
+            if len(subdir) != 2 or not os.path.isdir(subdir_path):
+                continue
+            with os.scandir(subdir_path) as it:
+                for entry in it:
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        # A temp file renamed into place as we listed
+                        continue
+                    if entry.name.startswith("tmp_"):
+                        if st.st_mtime_ns < cutoff:
+                            stale_temps.append(entry.path)
+                        continue
+                    loose[subdir + entry.name] = st
+        # Half-written packs from a fetch or repack that died
+        pack_dir = os.path.join(objects_dir, "pack")
+        if os.path.isdir(pack_dir):
+            with os.scandir(pack_dir) as it:
+                for entry in it:
+                    if not (entry.name.startswith("tmp_") or entry.name.endswith(".tmp")):
+                        continue
+                    try:
+                        if entry.stat().st_mtime_ns < cutoff:
+                            stale_temps.append(entry.path)
+                    except FileNotFoundError:
+                        continue
+        object_store.reload_packs()
+        packs = [(pack, os.stat(pack.pack_path)) for pack in object_store.packs]
+        # Disk usage rather than file sizes: thousands of tiny loose objects
+        # cost a block each
+        before = sum(st.st_blocks for st in loose.values()) + sum(
+            st.st_blocks + os.stat(pack.idx_path).st_blocks for pack, st in packs)
+        before += sum(os.stat(path).st_blocks for path in stale_temps)
+
+        # 2. Mark
+        kept = mark_reachable(gc_roots())
+        # Too new to judge, and whatever they point at: left loose so
+        # they keep aging, never packed
+        recent = {sha for sha, st in loose.items() if st.st_mtime_ns >= cutoff and sha not in kept}
+        protected = mark_reachable(recent) - kept
+        if len(packs) <= 1 and not stale_temps and all(sha in recent or sha in protected for sha in loose) \
+                and all(sha in kept for pack, _ in packs for sha in pack):
+            print(Fore.GREEN + Style.BRIGHT + "✔ gc: nothing to pack or prune")
+            return
+
+        # 3. One pack with everything kept. Deltas already in a pack are
+        #    reused when their base stays; new loose blobs get a delta search.
+        objects = []
+        packed = set()
+        pruned = 0
+        for pack, st in packs:
+            for sha in pack:
+                if sha in packed:
+                    continue
+                if sha not in kept:
+                    if sha in loose:
+                        pass
+                    elif sha in protected or st.st_mtime_ns >= cutoff:
+                        explode_object(sha, st.st_mtime_ns)
+                    else:
+                        pruned += 1
+                    continue
+                _, _, base = pack.locate(sha)
+                if base is not None and base in kept:
+                    objects.append((sha, bytes(pack.read_stored(sha)), base))
+                else:
+                    objects.append((sha, object_store.read_stored(sha), None))
+                packed.add(sha)
+        new_loose = [sha for sha in loose if sha in kept and sha not in packed]
+        bases = find_delta_bases(new_loose, window, depth) if window > 0 and depth > 0 else {}
+        for sha in new_loose:
+            base, delta = bases.get(sha, (None, None))
+            objects.append((sha, delta, base) if base is not None else (sha, pack_stored(sha), None))
+            packed.add(sha)
+
+        idx_path = write_pack(objects, sync=fsync_objects()) if objects else None
+        object_store.reload_packs()
+
+        # 4. Delete what the new pack replaces, and what's unreachable and old
+        for pack, st in packs:
+            if pack.idx_path == idx_path:
+                continue
+            if os.stat(pack.pack_path).st_mtime_ns != st.st_mtime_ns:
+                # Freshened since the snapshot: something is reusing its objects
+                continue
+            os.remove(pack.idx_path)
+            os.remove(pack.pack_path)
+        for sha, st in loose.items():
+            path = object_store.loose_path(sha)
+            if sha not in packed:
+                if sha in protected:
+                    continue
+                try:
+                    if os.stat(path).st_mtime_ns >= cutoff:
+                        continue
+                except FileNotFoundError:
+                    continue
+                pruned += 1
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        for path in stale_temps:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        for subdir in {sha[:2] for sha in loose}:
+            try:
+                os.rmdir(os.path.join(objects_dir, subdir))
+            except OSError:
+                pass
+
+        after = sum(os.stat(pack.pack_path).st_blocks + os.stat(pack.idx_path).st_blocks for pack in object_store.packs)
+        after += sum(os.stat(object_store.loose_path(sha)).st_blocks for sha in object_store.iter_loose_hashes())
+        before *= 512
+        after *= 512
+
+    elapsed = time.perf_counter() - started
+    print(Fore.GREEN + Style.BRIGHT + f"✔ gc: {len(packed)} objects packed ({len(bases)} new deltas), "
+          f"{pruned} unreachable objects pruned")
+    print(Fore.GREEN + f"  {before} -> {after} bytes on disk, {before - after} reclaimed in {elapsed:.2f}s")
+
+def pack_stored(sha):
+    # A loose object's stored bytes for a new pack. Loose objects were
+    # compressed at the interactive level; a repack may squeeze harder.
+    stored = object_store.read_stored(sha)
+    policy = compression_policy()
+    if policy.repack_level == policy.level:
+        return stored
+    raw = zlib.decompress(stored)
+    start = raw.index(b"\x00") + 1
+    if policy.is_incompressible(raw[start:start + SAMPLE_BYTES]):
+        # Recompressing won't win anything; keep what's there
+        return stored
+    return policy.compress(raw, policy.repack_level)
+
+def explode_object(sha, mtime_ns):
+    # Write a packed object back out loose, dated mtime_ns
+    path = object_store.loose_path(sha)
+    if os.path.exists(path):
+        return
+    stored = object_store.read_stored(sha)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix="tmp_")
+    with os.fdopen(fd, "wb") as f:
+        f.write(stored)
+    os.chmod(tmp_path, 0o644)
+    os.utime(tmp_path, ns=(mtime_ns, mtime_ns))
+    os.replace(tmp_path, path)
+
+def remote_url():
+    return load_config().get("RemoteUrl", "https://ctrlz.brodie-rogers.com").rstrip("/")
+
+def load_config():
+    import json
+    file_dir = ".ctrlz/config.json"
+    if not os.path.exists(file_dir):
+        return {}
+    with open(file_dir, "r") as file:
+        return json.load(file)
+
+CHUNK_SIZE = 1024 * 1024
+
+def cat_file_batch(contents=True, buffered=False):
+    # One object id per line on stdin. Each answer is "<id> <type> <size>\n",
+    # followed with --batch by the raw content and a newline, or
+    # "<id> missing\n". Packs, mmaps and the delta base cache stay open
+    # across requests. Every answer is flushed unless --buffer is given.
+    stdin = sys.stdin.buffer
+    out = sys.stdout.buffer
+    for line in stdin:
+        request = line.strip().decode(errors="replace")
+        sha = request.split(maxsplit=1)[0].lower() if request else ""
+        if len(sha) != 40 or not all(c in "0123456789abcdef" for c in sha):
+            out.write(f"{request} missing\n".encode())
+        elif contents:
+            opened = object_store.open_raw(sha)
+            if opened is None:
+                out.write(f"{sha} missing\n".encode())
+            else:
+                obj_type, size, chunks = opened
+                out.write(f"{sha} {obj_type} {size}\n".encode())
+                for chunk in chunks:
+                    out.write(chunk)
+                out.write(b"\n")
+        else:
+            header = object_store.read_header(sha)
+            if header is None:
+                out.write(f"{sha} missing\n".encode())
+            else:
+                out.write(f"{sha} {header[0]} {header[1]}\n".encode())
+        if not buffered:
+            out.flush()
+    out.flush()
 
+@trace.traced
 def hash_object(file_path: str) -> str:
     with open(file_path, 'rb') as f:
-        content = f.read()
+        size = os.fstat(f.fileno()).st_size
+
+        # Huge files, if asked: content-defined chunks behind a manifest
+        if is_chunked_size(size):
+            return hash_chunked(f, file_path)
+
+        # Small files: one read, hash and compress straight from memory
+        if size <= CHUNK_SIZE:
+            return hash_content(f.read(), file_path)
+
+        # Large files: hash first so existing objects never get compressed
+        sha = hashlib.sha1()
+        sample = None
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            if sample is None:
+                sample = chunk[:SAMPLE_BYTES]
+            sha.update(chunk)
+        hash = sha.hexdigest()
+        object_path = f".ctrlz/objects/{hash[:2]}/{hash[2:]}"
+        if has_object(hash):
+            return hash
+
+        f.seek(0)
+        verify = hashlib.sha1()
+        def chunks():
+            yield f"blob {size}\x00".encode()
+            read = 0
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                verify.update(chunk)
+                read += len(chunk)
+                yield chunk
+            if read != size:
+                raise RuntimeError(f"{file_path} changed while it was being hashed")
+        # Too big to buffer: written loose straight away, transaction or not
+        level, incompressible = compression_policy().level_for(sample or b"", file_path)
+        write_loose_object(object_path, chunks(), level, sync=fsync_objects(), incompressible=incompressible)
+        if verify.hexdigest() != hash:
+            os.remove(object_path)
+            raise RuntimeError(f"{file_path} changed while it was being hashed")
+    return hash
 
-    hash = hashlib.sha1(content).hexdigest()
-    object_dir = f".ctrlz/objects/{hash[:2]}"
-    if not os.path.exists(object_dir):
-        os.makedirs(object_dir)
-    object_path = f"{object_dir}/{hash[2:]}"
-    if not os.path.exists(object_path):
-        with open(object_path, 'wb') as obj_file:
-            obj_file.write(zlib.compress(f"blob {len(content)}\x00".encode() + content))
-            obj_file.close()
+def hash_content(content: bytes, name: str = None) -> str:
+    hash, stored = compress_blob(content, name)
+    if stored is not None:
+        write_object(hash, stored)
     return hash
 
+@trace.traced
+def hash_chunked(f, name: str = None, write: bool = True) -> str:
+    # Cut the file into content-defined chunks, store the new ones as blobs
+    # and the list of them as a manifest; returns the manifest's id. After an
+    # edit only the chunks around it are new, the rest are already here.
+    chunks = []
+    for chunk in chunker().split(f):
+        if write:
+            sha, stored = compress_blob(chunk, name)
+            if stored is not None:
+                write_object(sha, stored)
+            else:
+                trace.count("ChunksDeduplicated")
+        else:
+            sha = hashlib.sha1(chunk).hexdigest()
+        chunks.append((sha, len(chunk)))
+    content = format_manifest(chunks)
+    store = f"manifest {len(content)}\x00".encode() + content
+    manifest_hash = hashlib.sha1(store).hexdigest()
+    if write and not has_object(manifest_hash):
+        policy = compression_policy()
+        compressed = policy.compress(store, policy.level)
+        write_object(manifest_hash, compressed)
+        count_written(len(store), len(compressed))
+    return manifest_hash
+
+def compress_blob(content: bytes, name: str = None):
+    # (id, stored bytes), stored None if the object exists already
+    hash = hashlib.sha1(content).hexdigest()
+    if has_object(hash):
+        return hash, None
+    policy = compression_policy()
+    raw = f"blob {len(content)}\x00".encode() + content
+    stored = policy.compress(raw, *policy.level_for(content, name))
+    count_written(len(raw), len(stored))
+    return hash, stored
+
+def hash_path(path: str, mode: int = MODE_FILE) -> str:
+    # A symlink is stored as a blob holding its target
+    if mode == MODE_SYMLINK:
+        return hash_content(os.readlink(path).encode())
+    return hash_object(path)
+
+def hash_path_detached(path: str, mode: int = MODE_FILE):
+    # hash_path for a process pool worker, which can't add to the parent's
+    # transaction: returns (id, stored bytes) for the parent to add, stored
+    # None if there's nothing to add. Big files are written here, as ever.
+    # Third, what the worker compressed, for the parent's compression totals.
+    global _transaction
+    _transaction = None     # a forked copy of the parent's, not ours
+    compression_policy().log = written = []
+    if mode == MODE_SYMLINK:
+        return (*compress_blob(os.readlink(path).encode()), written)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= CHUNK_SIZE and not is_chunked_size(size):
+            return (*compress_blob(f.read(), path), written)
+    # The worker's own transaction, so a chunked file's chunks go out as a pack
+    with object_transaction():
+        sha = hash_object(path)
+    return sha, None, written
+
+def write_loose_object(object_path, chunks, level=zlib.Z_DEFAULT_COMPRESSION, sync=False, incompressible=False):
+    # Compress into a temp file next to the target and rename it into place,
+    # so readers never see a half-written object
+    import time
+    object_dir = os.path.dirname(object_path)
+    os.makedirs(object_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=object_dir, prefix="tmp_")
+    try:
+        os.fchmod(fd, 0o644)
+        compressor = zlib.compressobj(level)
+        raw_bytes = 0
+        seconds = 0.0
+        with os.fdopen(fd, "wb") as obj_file:
+            for chunk in chunks:
+                raw_bytes += len(chunk)
+                started = time.perf_counter()
+                compressed = compressor.compress(chunk)
+                seconds += time.perf_counter() - started
+                obj_file.write(compressed)
+            obj_file.write(compressor.flush())
+            stored_bytes = obj_file.tell()
+            if sync:
+                obj_file.flush()
+                os.fdatasync(obj_file.fileno())
+        os.replace(tmp_path, object_path)
+        if sync:
+            fsync_dir(object_dir)
+        compression_policy().record(raw_bytes, stored_bytes, seconds, incompressible)
+        count_written(raw_bytes, stored_bytes)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def count_written(raw_bytes, stored_bytes):
+    trace.count("ObjectsWritten")
+    trace.count("BytesCompressed", raw_bytes)
+    trace.count("BytesWritten", stored_bytes)
+
 def ls_tree(tree_hash: str):
     print(Fore.YELLOW + Style.BRIGHT + "\n=== Tree entries ===")
-    with open(f'.ctrlz/objects/{tree_hash[:2]}/{tree_hash[2:]}', 'rb') as f:
-        data = zlib.decompress(f.read())
-        _, tree_data = data.split(b'\x00', maxsplit=1)
-        offset = 0
-        while offset < len(tree_data):
-            # mode ends at first space
-            space_index = tree_data.find(b' ', offset)
-            if space_index == -1:
-                break
-            mode = tree_data[offset:space_index]
-            offset = space_index + 1
-
-            # name ends at first null byte
-            null_index = tree_data.find(b'\x00', offset)
-            if null_index == -1:
-                break
-            name = tree_data[offset:null_index]
-            offset = null_index + 1
-
-            # SHA-1 hash is next 20 bytes
-            sha_bytes = tree_data[offset:offset+20]
-            offset += 20
-
-            print(Fore.BLUE + "  " + Style.BRIGHT + name.decode('utf-8'))
+    for entry in object_store.read_tree(tree_hash):
+        print(Fore.BLUE + "  " + Style.BRIGHT + entry.name)
     print(Fore.YELLOW + "-" * 32)
 
-def write_tree(dir_path=".", print_hash=True):
-    ignore_rules = load_ignore_rules()
-    entries = []
-    for entry in sorted(os.listdir(dir_path)):
-        if entry.startswith(".ctrlz"):
-            continue 
-        full_path = os.path.join(dir_path, entry)
-        relative_path = os.path.relpath(full_path, start=".")
-        
-        if is_ignored(relative_path, ignore_rules):
-            continue
+@trace.traced
+def write_tree(print_hash=True, jobs=1, ignore_rules=None):
+    if ignore_rules is None:
+        ignore_rules = load_ignore_rules()
+
+    # 1. Walk the tree once, keeping the directory structure and resolving
+    #    what we can from the stat cache. With a watcher running, files it
+    #    hasn't seen change aren't even stat'ed.
+    from app.watch import dirty_paths
+    _, paths, _ = dirty_paths()
+    dirty_dirs = tuple(path + "/" for path in paths or ())
+    root = {}
+    nodes = {"": root}
+    pending = []
+    with Index() as index, trace.phase("walk"):
+        tracked = {entry.path: entry for entry in index}
+        for item in walk(".", ignore_rules, dirs=True, lstat=paths is None):
+            parent, _, name = item.path.rpartition("/")
+            if item.mode == MODE_TREE:
+                nodes[parent][name] = nodes[item.path] = {}
+                continue
+            cached = tracked.get(item.path)
+            if paths is not None:
+                if cached is not None and item.path not in paths and not item.path.startswith(dirty_dirs):
+                    nodes[parent][name] = cached
+                    continue
+                st = item.entry.stat(follow_symlinks=False)
+                item = item._replace(stat=st, mode=file_mode(st))
+            if cached is not None and index.is_fresh(cached, item.stat):
+                nodes[parent][name] = cached
+            else:
+                pending.append((nodes[parent], name, item))
+
+    # 2. Hash and compress the changed blobs, across a process pool if asked.
+    #    Blobs and trees are published together once the root tree is done.
+    with object_transaction():
+        if pending:
+            trace.count("FilesHashed", len(pending))
+            paths = [item.path for _, _, item in pending]
+            modes = [item.mode for _, _, item in pending]
+            if jobs == 1:
+                hashes = list(map(hash_path, paths, modes))
+            else:
+                import concurrent.futures
+                chunksize = max(1, len(paths) // (jobs * 8))
+                hashes = []
+                policy = compression_policy()
+                with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+                    for sha, stored, written in executor.map(hash_path_detached, paths, modes, chunksize=chunksize):
+                        for raw_bytes, stored_bytes, seconds, incompressible in written:
+                            policy.record(raw_bytes, stored_bytes, seconds, incompressible)
+                            count_written(raw_bytes, stored_bytes)
+                        if stored is not None:
+                            write_object(sha, stored)
+                        hashes.append(sha)
+            for (node, name, item), sha in zip(pending, hashes):
+                node[name] = entry_from_stat(item.path, item.stat, sha, item.mode)
+
+        # 3. Trees are cheap, build them bottom-up here
+        tree_hash = write_tree_node(root)
+    if print_hash:
+        print(Fore.MAGENTA + Style.BRIGHT + f"\nTree hash: {tree_hash}")
+    return tree_hash
 
-        entry_path = os.path.join(dir_path, entry)
-        if os.path.isdir(entry_path):
-            mode = b"40000"
-            sha = bytes.fromhex(write_tree(entry_path, print_hash=False))
-        else:
-            mode = b"100644"
-            sha = bytes.fromhex(hash_object(entry_path))
-        entries.append(mode + b" " + entry.encode() + b"\x00" + sha)
+def write_tree_object(entries, write=True):
     tree_data = b"".join(entries)
     header = f"tree {len(tree_data)}\x00".encode()
     store = header + tree_data
     tree_hash = hashlib.sha1(store).hexdigest()
-    object_dir = f".ctrlz/objects/{tree_hash[:2]}"
-    if not os.path.exists(object_dir):
-        os.makedirs(object_dir)
-    object_path = f"{object_dir}/{tree_hash[2:]}"
-    if not os.path.exists(object_path):
-        with open(object_path, "wb") as obj_file:
-            obj_file.write(zlib.compress(store))
-    if print_hash:
-        print(Fore.MAGENTA + Style.BRIGHT + f"\nTree hash: {tree_hash}")
+    if write and not has_object(tree_hash):
+        policy = compression_policy()
+        compressed = policy.compress(store, policy.level)
+        write_object(tree_hash, compressed)
+        count_written(len(store), len(compressed))
     return tree_hash
 
+def write_tree_from_index(index):
+    return write_tree_node(index_tree(index))
+
+def index_tree(entries):
+    # Rebuild the nested directory structure from the flat, sorted index
+    root = {}
+    for entry in entries:
+        parts = entry.path.split("/")
+        node = root
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = entry
+    return root
+
+@trace.traced
+def write_tree_node(node, write=True, hashes=None, prefix=""):
+    # Git tree order: a directory sorts as if its name ended in "/". With
+    # write=False nothing is stored; hashes, if given, collects every
+    # subtree's id keyed by its "dir/" prefix.
+    #
+    # Like git, a tree only has directories with files somewhere below them:
+    # an empty subtree returns None and is left out of its parent. The index
+    # can't hold an empty directory, so this is what makes write-tree (from
+    # the working tree) and commit (from the index) agree on the same files.
+    entries = []
+    for name in sorted(node, key=lambda name: name + "/" if isinstance(node[name], dict) else name):
+        child = node[name]
+        if isinstance(child, dict):
+            mode = b"40000"
+            sha = write_tree_node(child, write, hashes, prefix + name + "/")
+            if sha is None:
+                continue
+            sha = bytes.fromhex(sha)
+        else:
+            mode = f"{child.mode:o}".encode()
+            sha = bytes.fromhex(child.sha)
+        entries.append(mode + b" " + name.encode() + b"\x00" + sha)
+    if not entries and prefix:
+        return None
+    tree_hash = write_tree_object(entries, write)
+    if hashes is not None:
+        hashes[prefix] = tree_hash
+    return tree_hash
+
+def stage_file(path, index, st=None):
+    # Reuse the cached hash when the stat data says the file hasn't changed
+    if st is None:
+        st = os.lstat(path)
+    path = path.replace(os.sep, "/")
+    cached = index.lookup(path)
+    if cached is not None and index.is_fresh(cached, st):
+        return cached
+    mode = file_mode(st)
+    return entry_from_stat(path, st, hash_path(path, mode), mode)
+
 def commit_tree(tree_hash: str, message: str, parent: str = None):
+    import datetime
     lines = [f"tree {tree_hash}"]
     if parent:
         lines.append(f"parent {parent}")
@@ -400,101 +1469,236 @@ def commit_tree(tree_hash: str, message: str, parent: str = None):
     header = f"commit {len(commit_content)}\x00".encode()
     store = header + commit_content
     commit_hash = hashlib.sha1(store).hexdigest()
-    commit_dir = f".ctrlz/objects/{commit_hash[:2]}"
-    if not os.path.exists(commit_dir):
-        os.makedirs(commit_dir)
-    commit_path = f"{commit_dir}/{commit_hash[2:]}"
-    if not os.path.exists(commit_path):
-        with open(commit_path, "wb") as commit_file:
-            commit_file.write(zlib.compress(store))
+    # Its own transaction, published before it's read back for the graph
+    if not has_object(commit_hash):
+        policy = compression_policy()
+        compressed = policy.compress(store, policy.level)
+        write_object(commit_hash, compressed)
+        count_written(len(store), len(compressed))
+    add_to_commit_graph(commit_hash)
     return commit_hash
 
-def status():
-    index_path = ".ctrlz/index"
-    head_path = ".ctrlz/refs/heads/main"
-
-    # Read the latest commit hash
-    with open(head_path, "r") as head_file:
-        commit_hash = head_file.read().strip()
-
-    # Read the commit object and extract the tree hash
-    commit_obj_path = f".ctrlz/objects/{commit_hash[:2]}/{commit_hash[2:]}"
-    with open(commit_obj_path, "rb") as commit_file:
-        data = zlib.decompress(commit_file.read())
-        _, content = data.split(b'\x00', 1)
-        lines = content.decode().split('\n')
-        tree_hash = None
-        for line in lines:
-            if line.startswith("tree "):
-                tree_hash = line.split()[1]
-                break
+def add_to_commit_graph(*commit_hashes):
+    # Parents have to be in the graph before their children, so backfill any
+    # history that predates the graph
+    missing = []
+    seen = set()
+    with CommitGraph() as graph:
+        for commit_hash in commit_hashes:
+            chain = []
+            curr = commit_hash
+            while curr and curr not in seen and graph.position(curr) is None:
+                commit = object_store.read_commit(curr)
+                if commit is None:
+                    raise RuntimeError(f"Commit {curr} does not exist")
+                seen.add(curr)
+                chain.append((curr, commit.tree, commit.parent, commit.timestamp or 0))
+                curr = commit.parent
+            missing.extend(reversed(chain))
+    append_commits(missing)
+
+@trace.traced
+def status(porcelain=False):
+    from app.watch import dirty_paths, index_identity, save_state
+    head_commit = head_commit_hash()
+    head_tree = read_commit(head_commit)[0] if head_commit else None
+    token, paths, state = dirty_paths()
+
+    with Index() as index:
+        entries = None
+
+        # 1. Staged: HEAD against the trees the index would commit as. Those
+        #    are only hashed, and any subtree whose id matches HEAD's is
+        #    skipped without being read. With a watcher, the answer from the
+        #    last status is reused while neither the index nor HEAD moved.
+        if token is not None and "Staged" in state and state.get("Head") == head_tree \
+                and state.get("Index") == index_identity():
+            staged = [tuple(change) for change in state["Staged"]]
+        else:
+            entries = list(index)
+            hashes = {}
+            root = index_tree(entries)
+            write_tree_node(root, write=False, hashes=hashes)
+            staged = list(diff_index(head_tree, root, hashes))
+
+        # 2. Unstaged and untracked: the working tree against the index, or
+        #    only the paths the watcher reports
+        if paths is None and entries is None:
+            entries = list(index)
+        unstaged, untracked, refreshed = worktree_changes(index, entries, load_ignore_rules(), paths)
+
+        if refreshed:
+            # Files whose stat data changed but whose contents didn't: remember
+            # the new stat data so the next status doesn't read them again
+            write_index([refreshed.get(entry.path, entry) for entry in index])
+
+    if token is not None:
+        save_state(token, [path for _, path in unstaged] + untracked, Head=head_tree, Staged=staged)
+
+    if porcelain:
+        codes = {}
+        for code, path in staged:
+            codes[path] = code + " "
+        for code, path in unstaged:
+            codes[path] = codes.get(path, "  ")[0] + code
+        for path in untracked:
+            codes[path] = "??"
+        for path in sorted(codes):
+            print(f"{codes[path]} {path}")
+        return
 
-    # Read the tree object
-    tree_obj_path = f".ctrlz/objects/{tree_hash[:2]}/{tree_hash[2:]}"
-    with open(tree_obj_path, "rb") as tree_file:
-        tree_data = zlib.decompress(tree_file.read())
-        _, tree_entries = tree_data.split(b'\x00', 1)
-
-    print(Fore.YELLOW + Style.BRIGHT + "\n=== Committed tree entries ===")
-    offset = 0
-    while offset < len(tree_entries):
-        space_index = tree_entries.find(b' ', offset)
-        mode = tree_entries[offset:space_index].decode()
-        offset = space_index + 1
-        null_index = tree_entries.find(b'\x00', offset)
-        name = tree_entries[offset:null_index].decode()
-        offset = null_index + 1
-        sha_bytes = tree_entries[offset:offset+20]
-        sha = sha_bytes.hex()
-        offset += 20
-        print(Fore.BLUE + f"  {mode} {name} {sha}")
-
-    # Show staged changes
-    with open(index_path, "r") as index_file:
-        entries = index_file.readlines()
-
-    if not entries:
+    labels = {"A": "new file:", "M": "modified:", "D": "deleted: "}
+    for title, changes in (("Changes to be committed", staged), ("Changes not staged for commit", unstaged)):
+        if changes:
+            print(Fore.YELLOW + Style.BRIGHT + f"\n=== {title} ===")
+            for code, path in changes:
+                print(Fore.BLUE + f"  {labels[code]} {path}")
+    if untracked:
+        print(Fore.YELLOW + Style.BRIGHT + "\n=== Untracked files ===")
+        for path in untracked:
+            print(Fore.RED + f"  {path}")
+
+    if not staged and not unstaged and not untracked:
         print(Fore.GREEN + Style.BRIGHT + "\n✔ Nothing to commit, working tree clean")
     else:
-        print(Fore.YELLOW + Style.BRIGHT + "\n=== Changes to be committed ===")
-        for entry in entries:
-            print(Fore.BLUE + "  " + entry.strip())
         print(Fore.YELLOW + "-" * 32)
 
+def diff_index(tree_hash, node, hashes, prefix=""):
+    # Yields (code, path) for every file that differs between a HEAD tree and
+    # the index's nested node: A(dded), M(odified) or D(eleted)
+    if tree_hash is not None and tree_hash == hashes.get(prefix):
+        return
+    head = {e.name: e for e in object_store.read_tree(tree_hash)} if tree_hash else {}
+    for name in sorted(head.keys() | node.keys()):
+        h, i = head.get(name), node.get(name)
+        path = prefix + name
+        h_tree = h.sha if h is not None and h.mode == "40000" else None
+        i_tree = i if isinstance(i, dict) else None
+        h_blob = h if h is not None and h_tree is None else None
+        i_blob = i if i is not None and i_tree is None else None
+
+        if h_blob is not None and i_blob is None:
+            yield "D", path
+        elif i_blob is not None and h_blob is None:
+            yield "A", path
+        elif i_blob is not None and (h_blob.mode, h_blob.sha) != (f"{i_blob.mode:o}", i_blob.sha):
+            yield "M", path
+        if h_tree is not None or i_tree is not None:
+            yield from diff_index(h_tree, i_tree or {}, hashes, path + "/")
+
+@trace.traced
+def worktree_changes(index, entries, ignore_rules, paths=None):
+    # Merge the working tree walk against the sorted index entries (both are
+    # in path byte order), or with paths, only look at those. Returns
+    # (unstaged [(code, path)], untracked [path], refreshed {path: entry}).
+    # Contents are only read for files whose stat data no longer matches
+    # the index.
+    unstaged = []
+    untracked = []
+    refreshed = {}
+
+    def compare(entry, st):
+        mode = file_mode(st)
+        if mode == entry.mode and index.is_fresh(entry, st):
+            return
+        if mode != entry.mode or st.st_size != entry.size or not content_matches(entry.path, mode, entry.sha):
+            unstaged.append(("M", entry.path))
+        else:
+            refreshed[entry.path] = entry_from_stat(entry.path, st, entry.sha, entry.mode)
+
+    def missing(entry):
+        # Not seen by the walk: gone, or tracked despite an ignore rule
+        try:
+            st = os.lstat(entry.path)
+        except FileNotFoundError:
+            unstaged.append(("D", entry.path))
+            return
+        if stat.S_ISDIR(st.st_mode):
+            unstaged.append(("D", entry.path))
+        else:
+            compare(entry, st)
+
+    if paths is not None:
+        for path, st in sorted(rescan_paths(index, ignore_rules, paths).items()):
+            entry = index.lookup(path)
+            if entry is None:
+                untracked.append(path)
+            elif st is None:
+                missing(entry)
+            else:
+                compare(entry, st)
+        return unstaged, untracked, refreshed
+
+    tracked = iter(entries)
+    pending = next(tracked, None)
+    for item in walk(".", ignore_rules):
+        while pending is not None and pending.path < item.path:
+            missing(pending)
+            pending = next(tracked, None)
+        if pending is not None and pending.path == item.path:
+            compare(pending, item.stat)
+            pending = next(tracked, None)
+        else:
+            untracked.append(item.path)
+    while pending is not None:
+        missing(pending)
+        pending = next(tracked, None)
+    return unstaged, untracked, refreshed
+
+def rescan_paths(index, ignore_rules, paths):
+    # {path: lstat, or None to look up later} for every tracked file, and
+    # every file not ignored, at or under the given paths
+    found = {}
+    for path in paths:
+        for entry in index.iter_prefix(path + "/"):
+            found[entry.path] = None
+        if index.lookup(path) is not None:
+            found[path] = None
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            if not ignore_rules.ignored_path(path, True):
+                for item in walk(path, ignore_rules):
+                    found[item.path] = item.stat
+        elif (stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode)) \
+                and (path in found or not ignore_rules.ignored_path(path)):
+            found[path] = st
+    return found
+
+def content_sha(path, mode=MODE_FILE):
+    # The blob id a file would get, without storing anything
+    if mode == MODE_SYMLINK:
+        return hashlib.sha1(os.readlink(path).encode()).hexdigest()
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def content_matches(path, mode, sha):
+    # Whether the file holds object sha, hashed the way that object was
+    # stored: as one blob, or as chunks behind a manifest
+    if mode != MODE_SYMLINK and object_store.read_type(sha) == "manifest":
+        with open(path, "rb") as f:
+            return hash_chunked(f, write=False) == sha
+    return content_sha(path, mode) == sha
+
+@trace.traced
 def ls_commit():
     try:
-        objects_dir = ".ctrlz/objects"
         print(Fore.YELLOW + Style.BRIGHT + "\n=== Commits ===")
-        commits = []
-        for subdir in os.listdir(objects_dir):
-            subdir_path = os.path.join(objects_dir, subdir)
-            if not os.path.isdir(subdir_path):
-                continue
-            for obj_file in os.listdir(subdir_path):
-                obj_path = os.path.join(subdir_path, obj_file)
-                with open(obj_path, 'rb') as f:
-                    data = zlib.decompress(f.read())
-                    if data.startswith(b'commit '):
-                        commit_hash = subdir + obj_file
-                        # Extract timestamp from commit object
-                        try:
-                            _, content = data.split(b'\x00', 1)
-                            lines = content.decode('utf-8', errors='replace').split('\n')
-                            # Find committer line
-                            timestamp = None
-                            for line in lines:
-                                if line.startswith("committer "):
-                                    parts = line.split()
-                                    # Try to get the second last part as timestamp (if present and isdigit)
-                                    if len(parts) >= 3 and parts[-2].isdigit():
-                                        timestamp = int(parts[-2])
-                                    break
-                            commits.append((commit_hash, data, timestamp))
-                        except Exception:
-                            commits.append((commit_hash, data, None))
-
-        # Sort: first by timestamp (ascending), then those without timestamp at the end
-        commits.sort(key=lambda x: (x[2] is None, x[2] if x[2] is not None else 0))
+
+        # One-time full scan for repos that predate the commit-graph
+        if not os.path.exists(GRAPH_PATH):
+            add_to_commit_graph(*[obj_hash for obj_hash in object_store.iter_hashes()
+                                  if object_store.read_type(obj_hash) == "commit"])
+
+        with CommitGraph() as graph:
+            rows = sorted(graph, key=lambda c: (c.timestamp, c.generation))
+        commits = [(c.sha, object_store.read_raw(c.sha), c.timestamp) for c in rows]
+
         for commit_hash, data, _ in commits:
             print(Fore.MAGENTA + Style.BRIGHT + f"\nCommit: {commit_hash}")
             print(Fore.CYAN + Style.BRIGHT + "-" * 40)
@@ -506,67 +1710,63 @@ def ls_commit():
         sys.exit(1)
 
 
+@trace.traced
 def add(file_name: str = None):
     if file_name != '.':
         if os.path.exists(file_name):
-            if os.path.isdir(file_name):
-                mode = "40000"
-                sha = write_tree(file_name, print_hash=False)
-                entry = f"{mode} {file_name} {sha}"
-            else:
-                mode = "100644"
-                sha = hash_object(file_name)
-                entry = f"{mode} {file_name} {sha}"
-
-            index_path = ".ctrlz/index"
-            with open(index_path, "a") as index_file:
-                index_file.write(entry + "\n")
+            prefix = os.path.relpath(file_name, start=".").replace(os.sep, "/")
+            # New objects are published before the index that names them
+            with Index() as index, object_transaction():
+                if os.path.isdir(file_name) and not os.path.islink(file_name):
+                    new_entries = [stage_file(item.path, index, item.stat) for item in walk(file_name, load_ignore_rules())]
+                else:
+                    new_entries = [stage_file(prefix, index)]
+                # Keep everything outside the added path; what's under it is replaced
+                entries = [e for e in index if e.path != prefix and not e.path.startswith(prefix + "/")]
+            write_index(entries + new_entries)
             print(Fore.GREEN + Style.BRIGHT + f"✔ Added {file_name} to staging area")
     else:
 
-        working_dir = os.getcwd()
         if not os.path.exists(".ctrlz"):
             print(Fore.RED + Style.BRIGHT + "Not a git repository (or any of the parent directories): .ctrlz", file=sys.stderr)
             sys.exit(1)
 
-        # Read current index if exists
-        index_path = ".ctrlz/index"
-        current_entries = set()
-        if os.path.exists(index_path):
-            with open(index_path, "r") as index_file:
-                for line in index_file:
-                    current_entries.add(line.strip())
-
         try:
             # 1. Load ignore rules
+            from app.watch import dirty_paths, save_state
             ignore_rules = load_ignore_rules()
-            
-            entries = []
-            for entry in sorted(os.listdir(working_dir)):
-                if entry.startswith(".ctrlz"):
-                    continue
-                
-                # 2. Check if the file/folder is ignored
-                if is_ignored(entry, ignore_rules):
-                    continue 
-
-                if os.path.isdir(entry):
-                    mode = "40000"
-                    sha = write_tree(os.path.join(working_dir, entry), print_hash=False)
-                    entries.append(f"{mode} {entry} {sha}")
+            token, paths, _ = dirty_paths()
+
+            with Index() as index, object_transaction():
+                if paths is not None:
+                    # 2a. A watcher is running: only restage what it saw change
+                    unstaged, untracked, refreshed = worktree_changes(index, None, ignore_rules, paths)
+                    if not unstaged and not untracked and not refreshed:
+                        print(Fore.GREEN + Style.BRIGHT + "✔ Index is up to date, nothing to add")
+                        return
+                    entries = {entry.path: entry for entry in index}
+                    entries.update(refreshed)
+                    for code, path in unstaged:
+                        if code == "D":
+                            del entries[path]
+                        else:
+                            entries[path] = stage_file(path, index)
+                    for path in untracked:
+                        entries[path] = stage_file(path, index)
+                    entries = list(entries.values())
                 else:
-                    mode = "100644"
-                    sha = hash_object(os.path.join(working_dir, entry))
-                    entries.append(f"{mode} {entry} {sha}")
-
-            new_entries_set = set(entries)
-
-            if new_entries_set == current_entries:
-                print(Fore.GREEN + Style.BRIGHT + "✔ Index is up to date, nothing to add")
-                return
-
-            with open(index_path, "w") as index_file:
-                index_file.write("\n".join(entries) + "\n")
+                    # 2b. Restat everything, only hashing files whose stat data changed
+                    current_entries = list(index)
+                    entries = [stage_file(item.path, index, item.stat) for item in walk(".", ignore_rules)]
+                    if sorted(entries, key=lambda e: e.path.encode()) == current_entries:
+                        if token is not None:
+                            save_state(token, [])
+                        print(Fore.GREEN + Style.BRIGHT + "✔ Index is up to date, nothing to add")
+                        return
+
+            write_index(entries)
+            if token is not None:
+                save_state(token, [])
 
             print(Fore.GREEN + Style.BRIGHT + "✔ Added changes to staging area")
 
@@ -574,6 +1774,14 @@ def add(file_name: str = None):
             print(Fore.RED + Style.BRIGHT + "No such file or directory", file=sys.stderr)
             sys.exit(1)
 
+def head_commit_hash():
+    head_path = ".ctrlz/refs/heads/main"
+    if not os.path.exists(head_path):
+        return None
+    with open(head_path, "r") as head_file:
+        return head_file.read().strip() or None
+
+@trace.traced
 def commit_f(message: str = None):
     index_path = ".ctrlz/index"
 
@@ -581,169 +1789,220 @@ def commit_f(message: str = None):
         print(Fore.RED + Style.BRIGHT + "No changes added to commit", file=sys.stderr)
         sys.exit(1)
 
-    with open(index_path, "r") as index_file:
-        entries = index_file.readlines()
+    # The tree comes straight from the staged hashes, nothing is re-read.
+    # Trees are published before the commit, and that before the ref.
+    with Index() as index, object_transaction():
+        if not len(index):
+            print(Fore.RED + Style.BRIGHT + "No changes added to commit", file=sys.stderr)
+            sys.exit(1)
+        tree_hash = write_tree_from_index(index)
 
-    if not entries:
+    # The index outlives commits now, so "nothing staged" means "same tree as HEAD"
+    parent = head_commit_hash()
+    if parent and tree_hash == read_commit(parent)[0]:
         print(Fore.RED + Style.BRIGHT + "No changes added to commit", file=sys.stderr)
         sys.exit(1)
 
-    tree_hash = write_tree(print_hash=False)
     message = message or "blank commit message"
-    parent = None
 
     commit_hash = commit_tree(tree_hash, message, parent)
 
     if not os.path.exists(".ctrlz/refs/heads"):
         os.makedirs(".ctrlz/refs/heads")
-    if not os.path.exists(".ctrlz/refs/heads/main"):
-        with open(".ctrlz/refs/heads/main", "w") as ref_file:
-            ref_file.write(commit_hash + "\n")
-            ref_file.close()    
-
-    with open(index_path, "w") as index_file:
-        index_file.write("") 
-
+    with open(".ctrlz/refs/heads/main", "w") as ref_file:
+        ref_file.write(commit_hash + "\n")
 
     print(Fore.GREEN + Style.BRIGHT + f"\n✔ Committed as {commit_hash}\n" + Fore.YELLOW + "-" * 32)
 
-def checkout(hash: str):
+@trace.traced
+def checkout(hash: str, force: bool = False, jobs: int = None):
+    import concurrent.futures
+    import shutil
     head_path = ".ctrlz/refs/heads/main"
-    commit_obj_path = f".ctrlz/objects/{hash[:2]}/{hash[2:]}"
-    if not os.path.exists(commit_obj_path):
+    if not object_store.exists(hash):
         print(Fore.RED + Style.BRIGHT + f"Commit {hash} does not exist", file=sys.stderr)
         sys.exit(1)
-    # Update HEAD
-    with open(head_path, "w") as head_file:
-        head_file.write(hash + "\n")
     # Read commit object and get tree hash
-    with open(commit_obj_path, "rb") as f:
-        data = zlib.decompress(f.read())
-        _, content = data.split(b'\x00', 1)
-        lines = content.decode().split('\n')
-        tree_hash = None
-        for line in lines:
-            if line.startswith("tree "):
-                tree_hash = line.split()[1]
-                break
+    tree_hash, _ = read_commit(hash)
     if not tree_hash:
         print(Fore.RED + Style.BRIGHT + "No tree found in commit", file=sys.stderr)
         sys.exit(1)
 
-    # Remove all files/dirs except .ctrlz
-    for entry in os.listdir("."):
-        if entry == ".ctrlz":
+    head_commit = head_commit_hash()
+    head_tree = read_commit(head_commit)[0] if head_commit else None
+
+    # 1. Only the paths that differ between HEAD and the target get touched
+    #    (with --force, local edits too; see below)
+    changes = list(diff_trees(head_tree, tree_hash))
+
+    with Index() as index:
+        entries = {entry.path: entry for entry in index}
+
+        # 2. Refuse to clobber local edits, using the stat cache to spot them
+        conflicts = []
+        replaced = {path for path, old, _ in changes if old is not None}
+        for path, old, new in changes:
+            if old is None and path in replaced:
+                # A file turning into a directory; the file side is checked on its own
+                continue
+            if old is None:
+                # Don't replace untracked files, or directories holding them
+                if os.path.isdir(path) and not os.path.islink(path):
+                    conflicts.extend(item.path for item in walk(path) if item.path not in entries)
+                elif os.path.lexists(path):
+                    conflicts.append(path)
+            elif os.path.lexists(path):
+                cached = entries.get(path)
+                if cached is None or cached.sha != old.sha or not is_unmodified(index, cached):
+                    conflicts.append(path)
+        if conflicts and not force:
+            print(Fore.RED + Style.BRIGHT + "Your local changes would be overwritten by checkout:", file=sys.stderr)
+            for path in conflicts:
+                print(Fore.RED + f"  {path}", file=sys.stderr)
+            print(Fore.RED + "Commit them, or use --force to discard them.", file=sys.stderr)
+            sys.exit(1)
+        if force:
+            changes.extend(forced_changes(index, entries, tree_hash, {path for path, _, _ in changes}))
+
+    # 3. Deletions first (deepest first, so files go before the dirs holding them)
+    for path, old, new in reversed(changes):
+        if new is None:
+            if os.path.lexists(path):
+                os.remove(path)
+            entries.pop(path, None)
+            remove_empty_dirs(os.path.dirname(path))
+
+    # 4. Plan the creations: every directory is made up front, in tree order,
+    #    so none of the blob writes below has to wait on another
+    writes = []
+    dirs = set()
+    for path, old, new in changes:
+        if new is None:
             continue
-        entry_path = os.path.join(".", entry)
-        if os.path.isdir(entry_path):
-            # Recursively remove directory
-            import shutil
-            shutil.rmtree(entry_path)
-        else:
-            os.remove(entry_path)
-
-    # Restore files/dirs from tree
-    def restore_tree(tree_hash, path="."):
-        tree_obj_path = f".ctrlz/objects/{tree_hash[:2]}/{tree_hash[2:]}"
-        with open(tree_obj_path, "rb") as f:
-            data = zlib.decompress(f.read())
-            _, tree_data = data.split(b'\x00', 1)
-            offset = 0
-            while offset < len(tree_data):
-                space_index = tree_data.find(b' ', offset)
-                mode = tree_data[offset:space_index].decode()
-                offset = space_index + 1
-                null_index = tree_data.find(b'\x00', offset)
-                name = tree_data[offset:null_index].decode()
-                offset = null_index + 1
-                sha_bytes = tree_data[offset:offset+20]
-                sha = sha_bytes.hex()
-                offset += 20
-                if mode == "40000":
-                    # Directory
-                    dir_path = os.path.join(path, name)
-                    if not os.path.exists(dir_path):
-                        os.mkdir(dir_path)
-                    restore_tree(sha, dir_path)
-                else:
-                    # Blob (file)
-                    blob_obj_path = f".ctrlz/objects/{sha[:2]}/{sha[2:]}"
-                    with open(blob_obj_path, "rb") as bf:
-                        blob_data = zlib.decompress(bf.read())
-                        _, file_content = blob_data.split(b'\x00', 1)
-                        file_path = os.path.join(path, name)
-                        with open(file_path, "wb") as outf:
-                            outf.write(file_content)
-    restore_tree(tree_hash)
-    print(Fore.GREEN + Style.BRIGHT + f"✔ Checked out commit {hash} and updated working directory")
+        if new.mode == "40000":
+            dirs.add(path)
+            continue
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        dirs.add(os.path.dirname(path))
+        writes.append((path, new))
+    for dir_path in sorted(dirs):
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+
+    # 5. Decompress and write the blobs across a thread pool (zlib and file
+    #    I/O both release the GIL)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for entry in executor.map(materialize_blob, writes):
+            entries[entry.path] = entry
+
+    # 6. Move HEAD and leave the index matching what's on disk
+    write_index(entries.values())
+    with open(head_path, "w") as head_file:
+        head_file.write(hash + "\n")
+    print(Fore.GREEN + Style.BRIGHT + f"✔ Checked out commit {hash} and updated working directory ({len(changes)} paths changed)")
+
+def forced_changes(index, entries, tree_hash, changed):
+    # What checkout --force has to do on top of HEAD's diff to make the
+    # worktree and index match the target: put back files that are missing
+    # or edited, and drop tracked files the target doesn't have. A file whose
+    # stat data is stale but whose contents match only gets its index entry
+    # refreshed (in entries). A clean worktree costs one lstat per file.
+    target = set()
+    for path, _, new in diff_trees(None, tree_hash):
+        target.add(path)
+        if path in changed:
+            continue
+        if new.mode == "40000":
+            if not os.path.isdir(path) or os.path.islink(path):
+                yield path, None, new
+            continue
+        cached = entries.get(path)
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            st = None
+        if (st is None or cached is None or cached.sha != new.sha or cached.mode != int(new.mode, 8)
+                or file_mode(st) != cached.mode):
+            yield path, None, new
+        elif not index.is_fresh(cached, st):
+            if content_matches(path, cached.mode, cached.sha):
+                entries[path] = entry_from_stat(path, st, cached.sha, cached.mode)
+            else:
+                yield path, None, new
+    for path, cached in list(entries.items()):
+        if path not in target and path not in changed:
+            yield path, cached, None
+
+def materialize_blob(write):
+    path, tree_entry = write
+    # open_blob skips the shared LRU, which isn't safe to touch from threads,
+    # and streams, so a chunked file is put back together a chunk at a time
+    opened = object_store.open_blob(tree_entry.sha)
+    if opened is None:
+        raise RuntimeError(f"Object {tree_entry.sha} for {path} is missing")
+    _, chunks = opened
+    mode = int(tree_entry.mode, 8)
+    if os.path.islink(path) or (mode == MODE_SYMLINK and os.path.lexists(path)):
+        # Never write through an old link
+        os.remove(path)
+    if mode == MODE_SYMLINK:
+        os.symlink(b"".join(chunks), path)
+    else:
+        executable = mode == MODE_EXECUTABLE
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o777 if executable else 0o666)
+        with os.fdopen(fd, "wb") as outf:
+            perms = os.fstat(fd).st_mode & 0o777
+            if bool(perms & 0o100) != executable:
+                os.fchmod(fd, perms | 0o111 if executable else perms & ~0o111)
+            for chunk in chunks:
+                outf.write(chunk)
+    return entry_from_stat(path, os.lstat(path), tree_entry.sha, mode)
+
+def diff_trees(old_hash, new_hash, prefix=""):
+    # Yields (path, old TreeEntry, new TreeEntry) for every path that differs,
+    # either side None when absent. Subtrees with the same hash are skipped
+    # without being read. A new directory shows up as its own entry (mode
+    # 40000) before its contents. Trees written now never hold empty
+    # directories (see write_tree_node); older ones may, and still work.
+    if old_hash == new_hash:
+        return
+    old = {e.name: e for e in object_store.read_tree(old_hash)} if old_hash else {}
+    new = {e.name: e for e in object_store.read_tree(new_hash)} if new_hash else {}
+    for name in sorted(old.keys() | new.keys()):
+        o, n = old.get(name), new.get(name)
+        if o == n:
+            continue
+        path = prefix + name
+        o_tree = o.sha if o is not None and o.mode == "40000" else None
+        n_tree = n.sha if n is not None and n.mode == "40000" else None
+        o_blob = o if o is not None and o_tree is None else None
+        n_blob = n if n is not None and n_tree is None else None
+
+        if o_blob is not None or n_blob is not None:
+            yield path, o_blob, n_blob
+        if n_tree is not None and o_tree is None:
+            yield path, None, n
+        if o_tree is not None or n_tree is not None:
+            yield from diff_trees(o_tree, n_tree, path + "/")
+
+def is_unmodified(index, entry):
+    # Trust the stat cache when it's clean, otherwise compare contents
+    if index.is_fresh(entry, os.lstat(entry.path)):
+        return True
+    return content_matches(entry.path, entry.mode, entry.sha)
+
+def remove_empty_dirs(path):
+    # Remove path if it's a directory with nothing left in it, then its parents
+    while path and os.path.isdir(path) and not os.listdir(path):
+        os.rmdir(path)
+        path = os.path.dirname(path)
 
 def read_commit(commit_hash):
-    # 1. Construct path to object
-    path = f".ctrlz/objects/{commit_hash[:2]}/{commit_hash[2:]}"
-    
-    if not os.path.exists(path):
+    commit = object_store.read_commit(commit_hash)
+    if commit is None:
         return None, None
-
-    # 2. Read and decompress
-    with open(path, "rb") as f:
-        raw = zlib.decompress(f.read())
-        # Split header from content (commit <size>\0<content>)
-        _, content = raw.split(b'\x00', 1)
-        content = content.decode('utf-8')
-    
-    # 3. Extract Tree and Parent
-    tree_hash = None
-    parent_hash = None
-    
-    for line in content.split('\n'):
-        if line.startswith("tree "):
-            tree_hash = line.split()[1]
-        elif line.startswith("parent "):
-            parent_hash = line.split()[1]
-            
-    return tree_hash, parent_hash
-
-def find_objects_in_tree(tree_hash):
-    objects = set() # Use a set to avoid duplicates
-    
-    # 1. Read the tree object
-    path = f".ctrlz/objects/{tree_hash[:2]}/{tree_hash[2:]}"
-    if not os.path.exists(path):
-        return objects
-        
-    with open(path, "rb") as f:
-        obj_data = zlib.decompress(f.read())
-        # Split header "tree <size>\0" from content
-        _, content = obj_data.split(b'\x00', 1)
-        
-    # 2. Parse entries
-    offset = 0
-    while offset < len(content):
-        # Mode (e.g., 100644) ends at space
-        space_idx = content.find(b' ', offset)
-        mode = content[offset:space_idx]
-        offset = space_idx + 1
-        
-        # Name ends at null byte
-        null_idx = content.find(b'\x00', offset)
-        offset = null_idx + 1
-        
-        # Hash is the next 20 bytes
-        sha_bytes = content[offset:offset+20]
-        sha_hex = sha_bytes.hex()
-        offset += 20
-        
-        # Add this object to our collection
-        objects.add(sha_hex)
-        
-        # 3. If it's a directory (Tree), recurse!
-        # "40000" is the mode for directories in Git
-        if mode == b'40000':
-            sub_objects = find_objects_in_tree(sha_hex)
-            objects.update(sub_objects)
-            
-    return objects
+    return commit.tree, commit.parent
 
 if __name__ == "__main__":
-    print(Fore.YELLOW + "Python executable: " + Fore.WHITE + Style.BRIGHT + sys.executable, file=sys.stderr)
     main()
@@ -1,4 +1,455 @@
+import os
+import zlib
+import itertools
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+
+from app import trace
+from app.chunking import parse_manifest
+from app.delta import apply_delta, decode_varint, make_delta
+from app.pack import load_packs
+
+OBJECTS_DIR = ".ctrlz/objects"
+# Blobs bigger than this (stored) are never deltified; the line index alone
+# would cost more than the delta saves
+DELTA_MAX_BYTES = 64 * 1024 * 1024
+
+
 class Blob:
-    def __init__(self, content: str):
+    def __init__(self, content: bytes):
         self.content = content
-        self.size = len(content.encode('utf-8'))
\ No newline at end of file
+        self.size = len(content)
+
+
+class TreeEntry(NamedTuple):
+    mode: str
+    name: str
+    sha: str
+
+
+class Tree:
+    def __init__(self, entries):
+        self.entries = entries
+        self.size = sum(len(e.name) + 48 for e in entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+
+class Manifest:
+    # A big file stored as content-defined chunks (see app/chunking.py)
+    def __init__(self, content: bytes):
+        self.chunks = parse_manifest(content)
+        self.size = len(content)
+        self.file_size = sum(size for _, size in self.chunks)
+
+
+class Commit:
+    def __init__(self, data: bytes):
+        # data is the whole decompressed object, header included
+        self.data = data
+        self.size = len(data)
+        self.tree = None
+        self.parent = None
+        self.timestamp = None
+
+        _, content = data.split(b'\x00', 1)
+        for line in content.decode('utf-8', errors='replace').split('\n'):
+            if line.startswith("tree "):
+                self.tree = line.split()[1]
+            elif line.startswith("parent "):
+                self.parent = line.split()[1]
+            elif line.startswith("committer "):
+                parts = line.split()
+                if len(parts) >= 3 and parts[-2].isdigit():
+                    self.timestamp = int(parts[-2])
+            elif not line:
+                break
+
+
+def inflate(chunks, chunk_size: int):
+    # Decompressed output of a stream of zlib chunks, at most chunk_size at a time
+    decompressor = zlib.decompressobj()
+    for chunk in chunks:
+        while chunk:
+            out = decompressor.decompress(chunk, chunk_size)
+            if out:
+                yield out
+            chunk = decompressor.unconsumed_tail
+    out = decompressor.flush()
+    if out:
+        yield out
+
+
+def dir_mtime(path: str):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def touch(path: str) -> bool:
+    # False if the file is gone
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return False
+    except OSError:
+        # Read-only store: nothing can prune it either
+        pass
+    return True
+
+
+def inflate_prefix(chunks, length: int) -> bytes:
+    # The first `length` decompressed bytes (fewer if the stream is shorter),
+    # reading no more of chunks than that takes
+    decompressor = zlib.decompressobj()
+    out = b""
+    for chunk in chunks:
+        out += decompressor.decompress(chunk, length - len(out))
+        if len(out) >= length or decompressor.eof:
+            break
+    return out
+
+
+def parse_tree(tree_data: bytes):
+    entries = []
+    offset = 0
+    while offset < len(tree_data):
+        # mode ends at first space, name at the next null byte, then 20 bytes of sha
+        space_index = tree_data.find(b' ', offset)
+        if space_index == -1:
+            break
+        mode = tree_data[offset:space_index].decode()
+        offset = space_index + 1
+        null_index = tree_data.find(b'\x00', offset)
+        if null_index == -1:
+            break
+        name = tree_data[offset:null_index].decode()
+        offset = null_index + 1
+        entries.append(TreeEntry(mode, name, tree_data[offset:offset+20].hex()))
+        offset += 20
+    return entries
+
+
+class ObjectStore:
+    def __init__(self, objects_dir: str = OBJECTS_DIR, cache_bytes: int = 64 * 1024 * 1024,
+                 delta_cache_bytes: int = 32 * 1024 * 1024):
+        self.objects_dir = objects_dir
+        self.cache_bytes = cache_bytes
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._packs = None
+        self._packs_mtime = None
+        self._fresh_packs = set()
+        # Resolved delta bases, raw. Checkout reads through here from worker
+        # threads, hence the lock.
+        self.delta_cache_bytes = delta_cache_bytes
+        self._delta_bases = OrderedDict()
+        self._delta_cached_bytes = 0
+        self._delta_lock = threading.Lock()
+
+    @property
+    def packs(self):
+        if self._packs is None:
+            pack_dir = os.path.join(self.objects_dir, "pack")
+            self._packs_mtime = dir_mtime(pack_dir)
+            self._packs = load_packs(pack_dir)
+        return self._packs
+
+    def _packs_changed(self) -> bool:
+        # Called on a miss. A gc may have packed (and deleted) loose objects
+        # since the pack list was read, so look again if the pack directory
+        # has changed. Old packs aren't closed: other threads may be reading
+        # them, and unlinked files stay readable while mapped.
+        if self._packs is None or dir_mtime(os.path.join(self.objects_dir, "pack")) == self._packs_mtime:
+            return False
+        self._packs = None
+        return True
+
+    def reload_packs(self):
+        if self._packs is not None:
+            for pack in self._packs:
+                pack.close()
+        self._packs = None
+
+    def loose_path(self, sha: str) -> str:
+        return f"{self.objects_dir}/{sha[:2]}/{sha[2:]}"
+
+    def exists(self, sha: str) -> bool:
+        if sha in self._cache or any(sha in pack for pack in self.packs):
+            return True
+        return os.path.exists(self.loose_path(sha)) or (self._packs_changed() and self.exists(sha))
+
+    def freshen(self, sha: str) -> bool:
+        # exists() for writers about to reuse an object: also bumps its mtime
+        # (its pack's, if packed) so a gc running now treats it as new and
+        # doesn't prune it out from under us
+        for pack in self.packs:
+            if sha in pack:
+                if pack.pack_path not in self._fresh_packs:
+                    touch(pack.pack_path)
+                    self._fresh_packs.add(pack.pack_path)
+                return True
+        if touch(self.loose_path(sha)):
+            return True
+        return self._packs_changed() and self.freshen(sha)
+
+    def _locate(self, sha: str):
+        for pack in self.packs:
+            location = pack.locate(sha)
+            if location is not None:
+                return pack, location
+        return None
+
+    def delta_base(self, sha: str):
+        # The base a packed object is stored against, or None
+        found = self._locate(sha)
+        return found[1][2] if found is not None else None
+
+    def read_stored(self, sha: str):
+        # The object's zlib bytes, exactly as a loose file holds them: packs
+        # first (one mmap lookup), then loose. Delta entries get resolved.
+        found = self._locate(sha)
+        if found is not None:
+            pack, (offset, length, base) = found
+            if base is not None:
+                return zlib.compress(self.read_raw(sha))
+            trace.count("StoredBytesRead", length)
+            return pack.read_stored(sha)
+        path = self.loose_path(sha)
+        if not os.path.exists(path):
+            return self.read_stored(sha) if self._packs_changed() else None
+        with open(path, "rb") as f:
+            stored = f.read()
+        trace.count("StoredBytesRead", len(stored))
+        return stored
+
+    def open_stored(self, sha: str, chunk_size: int = 1024 * 1024):
+        # (length, chunks) of the stored zlib bytes, without holding them all at once
+        found = self._locate(sha)
+        if found is not None:
+            pack, (offset, length, base) = found
+            if base is not None:
+                stored = self.read_stored(sha)
+                return len(stored), iter([stored])
+            trace.count("StoredBytesRead", length)
+            return length, pack.iter_stored(offset, length, chunk_size)
+        path = self.loose_path(sha)
+        if not os.path.exists(path):
+            return self.open_stored(sha, chunk_size) if self._packs_changed() else None
+
+        def chunks():
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(chunk_size), b""):
+                    yield chunk
+        length = os.path.getsize(path)
+        trace.count("StoredBytesRead", length)
+        return length, chunks()
+
+    def stored_size(self, sha: str):
+        # Bytes on disk; for a delta entry that's the delta, not the object
+        found = self._locate(sha)
+        if found is not None:
+            return found[1][1]
+        path = self.loose_path(sha)
+        if os.path.exists(path):
+            return os.path.getsize(path)
+        return self.stored_size(sha) if self._packs_changed() else None
+
+    def read_raw(self, sha: str):
+        # Whole decompressed object, "<type> <size>\0" header included. Not cached.
+        found = self._locate(sha)
+        if found is not None and found[1][2] is not None:
+            pack, (_, _, base) = found
+            base_type, base_content = self._read_delta_base(base)
+            content = apply_delta(base_content, zlib.decompress(pack.read_stored(sha)))
+            trace.count("ObjectsRead")
+            trace.count("DeltasApplied")
+            trace.count("BytesDecompressed", len(content))
+            return f"{base_type} {len(content)}".encode() + b"\x00" + content
+        stored = self.read_stored(sha)
+        if stored is None:
+            return None
+        raw = zlib.decompress(stored)
+        trace.count("ObjectsRead")
+        trace.count("BytesDecompressed", len(raw))
+        return raw
+
+    def _read_delta_base(self, sha: str):
+        # (type, content) of a delta base. Deltas in a chain all lean on the
+        # same few bases, so those are kept around once resolved.
+        with self._delta_lock:
+            cached = self._delta_bases.get(sha)
+            if cached is not None:
+                self._delta_bases.move_to_end(sha)
+                return cached
+        header, content = self.read_raw(sha).split(b"\x00", 1)
+        resolved = (header.split(b" ", 1)[0].decode(), content)
+        if len(content) <= self.delta_cache_bytes // 4:
+            with self._delta_lock:
+                if sha not in self._delta_bases:
+                    self._delta_bases[sha] = resolved
+                    self._delta_cached_bytes += len(content)
+                while self._delta_cached_bytes > self.delta_cache_bytes:
+                    _, (_, evicted) = self._delta_bases.popitem(last=False)
+                    self._delta_cached_bytes -= len(evicted)
+        return resolved
+
+    def delta_against(self, sha: str, base: str):
+        # A zlib'd delta that rebuilds blob `sha` from blob `base`, or None
+        # when sending the whole object would be about as cheap
+        found = self._locate(sha)
+        if found is not None and found[1][2] == base:
+            return bytes(found[0].read_stored(sha))
+        full_size = self.stored_size(sha)
+        if full_size is None or full_size > DELTA_MAX_BYTES or self.read_type(sha) != "blob":
+            return None
+        base_raw = self.read_raw(base)
+        if base_raw is None or not base_raw.startswith(b"blob "):
+            return None
+        content = self.read_raw(sha).split(b"\x00", 1)[1]
+        delta = zlib.compress(make_delta(base_raw.split(b"\x00", 1)[1], content))
+        return delta if len(delta) < full_size // 2 else None
+
+    def read_type(self, sha: str):
+        obj = self._cache.get(sha)
+        if obj is not None:
+            return {Commit: "commit", Tree: "tree", Blob: "blob", Manifest: "manifest"}[type(obj)]
+        header = self.read_header(sha)
+        return header[0] if header is not None else None
+
+    def read_header(self, sha: str):
+        # (type, size) or None. Stored bytes are only read and inflated as far
+        # as the header, so blobs cost almost nothing; a delta entry's size
+        # is at the front of the delta and its type is its base's.
+        found = self._locate(sha)
+        if found is not None:
+            pack, (offset, length, base) = found
+            head = inflate_prefix(pack.iter_stored(offset, length, 256), 20 if base else 32)
+            if base is not None:
+                _, at = decode_varint(head, 0)
+                return self.read_header(base)[0], decode_varint(head, at)[0]
+        else:
+            path = self.loose_path(sha)
+            if not os.path.exists(path):
+                return self.read_header(sha) if self._packs_changed() else None
+            with open(path, "rb") as f:
+                head = inflate_prefix(iter(lambda: f.read(256), b""), 32)
+        obj_type, size = head.split(b"\x00", 1)[0].split(b" ", 1)
+        return obj_type.decode(), int(size)
+
+    def open_raw(self, sha: str, chunk_size: int = 1024 * 1024):
+        # (type, size, content chunks) or None, inflated a buffer at a time
+        # so a huge blob never has to be in memory whole
+        found = self._locate(sha)
+        if found is not None and found[1][2] is not None:
+            header, content = self.read_raw(sha).split(b"\x00", 1)
+            obj_type, size = header.split(b" ", 1)
+            return obj_type.decode(), int(size), iter([content])
+        opened = self.open_stored(sha, chunk_size)
+        if opened is None:
+            return None
+        pieces = inflate(opened[1], chunk_size)
+        head = b""
+        while b"\x00" not in head:
+            piece = next(pieces, None)
+            if piece is None:
+                raise ValueError(f"Object {sha} is truncated")
+            head += piece
+        header, rest = head.split(b"\x00", 1)
+        obj_type, size = header.split(b" ", 1)
+        trace.count("ObjectsRead")
+        trace.count("BytesDecompressed", int(size))
+        return obj_type.decode(), int(size), itertools.chain([rest], pieces)
+
+    def open_blob(self, sha: str, chunk_size: int = 1024 * 1024):
+        # (size, content chunks) of a file, stored whole or as a manifest of
+        # chunks; streamed either way. None if missing or not a file.
+        opened = self.open_raw(sha, chunk_size)
+        if opened is None:
+            return None
+        obj_type, size, chunks = opened
+        if obj_type == "blob":
+            return size, chunks
+        if obj_type != "manifest":
+            return None
+        manifest = Manifest(b"".join(chunks))
+
+        def pieces():
+            for chunk_sha, _ in manifest.chunks:
+                opened = self.open_raw(chunk_sha, chunk_size)
+                if opened is None:
+                    raise ValueError(f"Chunk {chunk_sha} of {sha} is missing")
+                yield from opened[2]
+        return manifest.file_size, pieces()
+
+    def read(self, sha: str):
+        obj = self._cache.get(sha)
+        if obj is not None:
+            self.hits += 1
+            self._cache.move_to_end(sha)
+            return obj
+        self.misses += 1
+
+        data = self.read_raw(sha)
+        if data is None:
+            return None
+        header, content = data.split(b'\x00', 1)
+        obj_type = header.split(b' ', 1)[0]
+        if obj_type == b"commit":
+            obj = Commit(data)
+        elif obj_type == b"tree":
+            obj = Tree(parse_tree(content))
+        elif obj_type == b"manifest":
+            obj = Manifest(content)
+        else:
+            obj = Blob(content)
+        self._remember(sha, obj)
+        return obj
+
+    def read_commit(self, sha: str):
+        obj = self.read(sha)
+        return obj if isinstance(obj, Commit) else None
+
+    def read_tree(self, sha: str):
+        obj = self.read(sha)
+        return obj if isinstance(obj, Tree) else None
+
+    def read_manifest(self, sha: str):
+        obj = self.read(sha)
+        return obj if isinstance(obj, Manifest) else None
+
+    def _remember(self, sha, obj):
+        # Anything bigger than a quarter of the budget would just flush the cache
+        if obj.size > self.cache_bytes // 4:
+            return
+        self._cache[sha] = obj
+        self.cached_bytes += obj.size
+        while self.cached_bytes > self.cache_bytes:
+            _, evicted = self._cache.popitem(last=False)
+            self.cached_bytes -= evicted.size
+
+    def iter_hashes(self):
+        seen = set()
+        for pack in self.packs:
+            for sha in pack:
+                seen.add(sha)
+                yield sha
+        for subdir in os.listdir(self.objects_dir):
+            subdir_path = os.path.join(self.objects_dir, subdir)
+            if len(subdir) != 2 or not os.path.isdir(subdir_path):
+                continue
+            for obj_file in os.listdir(subdir_path):
+                if obj_file.startswith("tmp_") or subdir + obj_file in seen:
+                    continue
+                yield subdir + obj_file
+
+    def iter_loose_hashes(self):
+        packed = set()
+        for pack in self.packs:
+            packed.update(pack)
+        return (sha for sha in self.iter_hashes() if sha not in packed)
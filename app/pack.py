@@ -0,0 +1,214 @@
+import os
+import mmap
+import struct
+import hashlib
+import tempfile
+
+PACK_DIR = ".ctrlz/objects/pack"
+
+# A pack is the objects' zlib streams (exactly what a loose file holds) laid
+# end to end. The .idx next to it is what makes lookups cheap:
+#   header | fanout[256] | sorted shas (20 bytes each) | location per sha
+# fanout[b] is the number of shas whose first byte is <= b, so a lookup is a
+# binary search inside one fanout bucket, straight out of the mmap.
+#
+# Since version 2 a location also names a base: the position of another
+# object in the same pack. Those entries hold a zlib'd delta (app/delta.py)
+# against that base instead of the object itself.
+PACK_MAGIC = b"CZPK"
+IDX_MAGIC = b"CZPI"
+VERSION = 2
+HEADER = struct.Struct(">4sII")            # magic, version, object count
+FANOUT = struct.Struct(">256I")
+LOCATIONS = {
+    1: struct.Struct(">QQ"),               # offset into the .pack, stored length
+    2: struct.Struct(">QQI"),              # ... and the delta base's position
+}
+NO_BASE = 0xFFFFFFFF
+
+
+class Pack:
+    def __init__(self, idx_path: str):
+        self.idx_path = idx_path
+        self.pack_path = idx_path[:-len(".idx")] + ".pack"
+
+        with open(idx_path, "rb") as f:
+            self._idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count = HEADER.unpack_from(self._idx, 0)
+        if magic != IDX_MAGIC or version not in LOCATIONS:
+            raise RuntimeError(f"{idx_path} is not a ctrlz pack index")
+        self._location = LOCATIONS[version]
+        self._fanout = FANOUT.unpack_from(self._idx, HEADER.size)
+        self._shas = HEADER.size + FANOUT.size
+        self._locations = self._shas + self.count * 20
+
+        with open(self.pack_path, "rb") as f:
+            self._pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        self._idx.close()
+        self._pack.close()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self._sha(i).hex()
+
+    def __contains__(self, sha: str):
+        return self._find(sha) is not None
+
+    def _sha(self, i):
+        start = self._shas + i * 20
+        return self._idx[start:start + 20]
+
+    def _find(self, sha: str):
+        key = bytes.fromhex(sha)
+        lo = self._fanout[key[0] - 1] if key[0] else 0
+        hi = self._fanout[key[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            candidate = self._sha(mid)
+            if candidate < key:
+                lo = mid + 1
+            elif candidate > key:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def locate(self, sha: str):
+        # (offset, length, base sha or None)
+        i = self._find(sha)
+        if i is None:
+            return None
+        offset, length, *base = self._location.unpack_from(self._idx, self._locations + i * self._location.size)
+        if not base or base[0] == NO_BASE:
+            return offset, length, None
+        return offset, length, self._sha(base[0]).hex()
+
+    def read_stored(self, sha: str):
+        # Stored bytes as they are in the pack; for a delta entry that's the zlib'd delta
+        location = self.locate(sha)
+        if location is None:
+            return None
+        offset, length, _ = location
+        return self._pack[offset:offset + length]
+
+    def iter_stored(self, offset: int, length: int, chunk_size: int):
+        for start in range(offset, offset + length, chunk_size):
+            yield self._pack[start:min(start + chunk_size, offset + length)]
+
+
+def fsync_dir(path: str):
+    # Makes the renames and new names in a directory durable
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class PackWriter:
+    # Builds a pack as objects come in (a fetch writes them straight off the
+    # wire), then indexes it in finish(). Until then it's a tmp_ file that
+    # nothing reads.
+    def __init__(self, pack_dir: str = PACK_DIR):
+        os.makedirs(pack_dir, exist_ok=True)
+        self.pack_dir = pack_dir
+        fd, self.tmp_path = tempfile.mkstemp(dir=pack_dir, prefix="tmp_", suffix=".pack")
+        os.fchmod(fd, 0o644)
+        self._file = os.fdopen(fd, "wb")
+        self._file.write(HEADER.pack(PACK_MAGIC, VERSION, 0))
+        self._offset = HEADER.size
+        self._entries = {}          # sha -> (offset, length, base sha or None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, sha: str):
+        return sha in self._entries
+
+    def add(self, sha: str, stored: bytes, base: str = None):
+        # stored: zlib bytes as a loose file holds them, or with a base, a
+        # zlib'd delta against it (the base has to end up in this pack too)
+        if sha in self._entries:
+            return
+        self._file.write(stored)
+        self._entries[sha] = (self._offset, len(stored), base)
+        self._offset += len(stored)
+
+    def finish(self, sync: bool = False):
+        # Index and publish the pack; returns the .idx path, or None if empty.
+        # With sync, both files and the directory are fsync'd on the way.
+        if not self._entries:
+            self.abort()
+            return None
+        shas = sorted(self._entries)
+        positions = {sha: i for i, sha in enumerate(shas)}
+        self._file.seek(0)
+        self._file.write(HEADER.pack(PACK_MAGIC, VERSION, len(shas)))
+        if sync:
+            self._file.flush()
+            os.fdatasync(self._file.fileno())
+        self._file.close()
+
+        fanout = [0] * 256
+        locations = []
+        for sha in shas:
+            offset, length, base = self._entries[sha]
+            locations.append(LOCATIONS[VERSION].pack(offset, length, NO_BASE if base is None else positions[base]))
+            fanout[int(sha[:2], 16)] += 1
+        for i in range(1, 256):
+            fanout[i] += fanout[i - 1]
+
+        name = hashlib.sha1("".join(shas).encode()).hexdigest()
+        pack_path = os.path.join(self.pack_dir, f"pack-{name}.pack")
+        idx_path = os.path.join(self.pack_dir, f"pack-{name}.idx")
+        with open(idx_path + ".tmp", "wb") as f:
+            f.write(HEADER.pack(IDX_MAGIC, VERSION, len(shas)))
+            f.write(FANOUT.pack(*fanout))
+            f.write(b"".join(bytes.fromhex(sha) for sha in shas))
+            f.write(b"".join(locations))
+            if sync:
+                f.flush()
+                os.fdatasync(f.fileno())
+
+        # The .pack has to be in place before its .idx makes it visible
+        os.replace(self.tmp_path, pack_path)
+        os.replace(idx_path + ".tmp", idx_path)
+        if sync:
+            fsync_dir(self.pack_dir)
+        return idx_path
+
+    def abort(self):
+        self._file.close()
+        os.remove(self.tmp_path)
+
+
+def write_pack(objects, pack_dir: str = PACK_DIR, sync: bool = False):
+    # objects: iterable of (sha, stored zlib bytes, delta base sha or None);
+    # a base has to be in the same pack. Returns the .idx path.
+    writer = PackWriter(pack_dir)
+    try:
+        for sha, stored, base in sorted(objects, key=lambda o: o[0]):
+            writer.add(sha, stored, base)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.finish(sync)
+
+
+def load_packs(pack_dir: str = PACK_DIR):
+    if not os.path.isdir(pack_dir):
+        return []
+    packs = []
+    for name in sorted(os.listdir(pack_dir)):
+        if name.endswith(".idx"):
+            try:
+                packs.append(Pack(os.path.join(pack_dir, name)))
+            except FileNotFoundError:
+                # Removed by a gc between the listing and the open
+                continue
+    return packs
@@ -0,0 +1,298 @@
+import os
+import sys
+import json
+import zlib
+import hashlib
+import time
+import random
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from app.delta import apply_delta
+from app.transfer import CHUNK_SIZE, DELTA, FRAME, FULL, read_exact, read_frames
+
+# A local stand-in for the ctrlz push server, for testing and benchmarks.
+# Repos live under <root>/<user>/<repo>/ with loose objects and ref files.
+
+
+def object_id(obj_type: bytes, header: bytes, content: bytes) -> str:
+    # Blobs are addressed by their content alone, trees and commits by header + content
+    if obj_type == b"blob":
+        return hashlib.sha1(content).hexdigest()
+    return hashlib.sha1(header + b"\x00" + content).hexdigest()
+
+
+class ChunkedReader:
+    # Decodes a Transfer-Encoding: chunked request body on the fly
+    def __init__(self, stream):
+        self.stream = stream
+        self.remaining = 0
+        self.done = False
+
+    def read(self, size: int) -> bytes:
+        if self.done:
+            return b""
+        if not self.remaining:
+            line = self.stream.readline()
+            self.remaining = int(line.split(b";")[0].strip(), 16)
+            if not self.remaining:
+                # Trailer section ends with an empty line
+                while self.stream.readline() not in (b"\r\n", b"\n", b""):
+                    pass
+                self.done = True
+                return b""
+        data = self.stream.read(min(size, self.remaining))
+        self.remaining -= len(data)
+        if not self.remaining:
+            self.stream.readline()
+        return data
+
+
+class LimitedReader:
+    def __init__(self, stream, length: int):
+        self.stream = stream
+        self.remaining = length
+
+    def read(self, size: int) -> bytes:
+        data = self.stream.read(min(size, self.remaining)) if self.remaining else b""
+        self.remaining -= len(data)
+        return data
+
+
+class RepoStore:
+    def __init__(self, root: str):
+        self.root = root
+
+    def repo_dir(self, user: str, repo: str) -> str:
+        path = os.path.join(self.root, user, repo)
+        os.makedirs(os.path.join(path, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(path, "refs"), exist_ok=True)
+        return path
+
+    def object_path(self, user: str, repo: str, sha: str) -> str:
+        return os.path.join(self.repo_dir(user, repo), "objects", sha[:2], sha[2:])
+
+    def has(self, user: str, repo: str, sha: str) -> bool:
+        return os.path.exists(self.object_path(user, repo, sha))
+
+    def store(self, user: str, repo: str, sha: str, stored: bytes):
+        path = self.object_path(user, repo, sha)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(stored)
+        os.replace(path + ".tmp", path)
+
+    def store_stream(self, user: str, repo: str, sha: str, chunks) -> bool:
+        # Write the stored bytes through, inflating alongside only to check the id
+        path = self.object_path(user, repo, sha)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{id(chunks)}.tmp"
+        decompressor = zlib.decompressobj()
+        header = b""
+        digest = None
+        with open(tmp_path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                data = decompressor.decompress(chunk)
+                if digest is None:
+                    header += data
+                    if b"\x00" not in header:
+                        continue
+                    header, data = header.split(b"\x00", 1)
+                    digest = hashlib.sha1() if header.startswith(b"blob ") else hashlib.sha1(header + b"\x00")
+                digest.update(data)
+        if digest is None or digest.hexdigest() != sha:
+            os.remove(tmp_path)
+            return False
+        os.replace(tmp_path, path)
+        return True
+
+    def store_delta(self, user: str, repo: str, sha: str, payload: bytes) -> bool:
+        # payload: base id + zlib'd delta. The base has to be here already.
+        base_path = self.object_path(user, repo, payload[:20].hex())
+        if not os.path.exists(base_path):
+            return False
+        with open(base_path, "rb") as f:
+            base_header, base_content = zlib.decompress(f.read()).split(b"\x00", 1)
+        content = apply_delta(base_content, zlib.decompress(payload[20:]))
+        obj_type = base_header.split(b" ", 1)[0]
+        header = obj_type + b" " + str(len(content)).encode()
+        if object_id(obj_type, header, content) != sha:
+            return False
+        self.store(user, repo, sha, zlib.compress(header + b"\x00" + content))
+        return True
+
+    def read_ref(self, user: str, repo: str, branch: str):
+        path = os.path.join(self.repo_dir(user, repo), "refs", branch)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return f.read().strip()
+
+    def write_ref(self, user: str, repo: str, branch: str, sha: str):
+        path = os.path.join(self.repo_dir(user, repo), "refs", branch)
+        with open(path, "w") as f:
+            f.write(sha + "\n")
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Streamed replies go out as several writes; don't let Nagle hold them
+    disable_nagle_algorithm = True
+    repos: RepoStore = None
+    latency = 0.0        # seconds added to every request
+    error_rate = 0.0     # fraction of requests answered with a 503
+
+    def injected_fault(self) -> bool:
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            # Drain whatever was sent so the connection stays usable
+            stream = self.body_stream()
+            while read_exact(stream, 65536):
+                pass
+            self.reply(503, b"injected failure")
+            return True
+        return False
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status: int, body: bytes = b"", content_type: str = "text/plain"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def write_chunk(self, data: bytes):
+        self.wfile.write(b"%x\r\n" % len(data) + data + b"\r\n")
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def body_stream(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            return ChunkedReader(self.rfile)
+        return LimitedReader(self.rfile, int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self):
+        if self.injected_fault():
+            return
+        parts = self.path.strip("/").split("/")
+        if len(parts) == 4 and parts[0] == "refs":
+            sha = self.repos.read_ref(parts[1], parts[2], parts[3])
+            if sha is None:
+                return self.reply(404, b"ref not found")
+            return self.reply(200, sha.encode())
+        self.reply(404, b"not found")
+
+    def do_POST(self):
+        if self.injected_fault():
+            return
+        parts = self.path.strip("/").split("/")
+        if len(parts) != 3:
+            return self.reply(404, b"not found")
+        endpoint, user, repo = parts
+
+        if endpoint == "update-ref":
+            payload = json.loads(self.read_body())
+            self.repos.write_ref(user, repo, payload["Ref"], payload["Hash"])
+            return self.reply(200, b"ok")
+
+        if endpoint == "missing":
+            payload = json.loads(self.read_body())
+            missing = [sha for sha in payload["Hashes"] if not self.repos.has(user, repo, sha)]
+            return self.reply(200, json.dumps({"Missing": missing}).encode(), "application/json")
+
+        if endpoint == "upload-stream":
+            # Framed, still-compressed objects (see app/transfer.py)
+            stream = self.body_stream()
+            bad = []
+            for sha, kind, _, chunks in read_frames(stream):
+                if self.repos.has(user, repo, sha):
+                    for _ in chunks:
+                        pass
+                elif kind == DELTA:
+                    if not self.repos.store_delta(user, repo, sha, b"".join(chunks)):
+                        bad.append(sha)
+                elif not self.repos.store_stream(user, repo, sha, chunks):
+                    bad.append(sha)
+            while read_exact(stream, 65536):
+                pass
+            if bad:
+                return self.reply(400, f"Objects failed verification: {' '.join(bad)}".encode())
+            return self.reply(200, b"ok")
+
+        if endpoint == "download-stream":
+            # The requested objects as FULL frames, straight from disk; ones
+            # this repo doesn't have are left out
+            payload = json.loads(self.read_body())
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            # Small objects are gathered into one chunk, not a write each
+            out = bytearray()
+            for sha in payload["Hashes"]:
+                path = self.repos.object_path(user, repo, sha)
+                try:
+                    f = open(path, "rb")
+                except FileNotFoundError:
+                    continue
+                with f:
+                    out += FRAME.pack(bytes.fromhex(sha), FULL, os.fstat(f.fileno()).st_size)
+                    while chunk := f.read(CHUNK_SIZE):
+                        out += chunk
+                        if len(out) >= CHUNK_SIZE:
+                            self.write_chunk(bytes(out))
+                            out.clear()
+            if out:
+                self.write_chunk(bytes(out))
+            self.write_chunk(b"")
+            return
+
+        if endpoint == "upload-batch":
+            # Decompressed objects back to back: "<type> <size>\0<content>..."
+            data = self.read_body()
+            offset = 0
+            while offset < len(data):
+                null_index = data.index(b"\x00", offset)
+                header = data[offset:null_index]
+                obj_type, size = header.split(b" ")
+                content = data[null_index + 1:null_index + 1 + int(size)]
+                offset = null_index + 1 + int(size)
+                sha = object_id(obj_type, header, content)
+                self.repos.store(user, repo, sha, zlib.compress(header + b"\x00" + content))
+            return self.reply(200, b"ok")
+
+        self.reply(404, b"not found")
+
+
+def make_server(root: str, host: str = "127.0.0.1", port: int = 0,
+                latency: float = 0.0, error_rate: float = 0.0) -> ThreadingHTTPServer:
+    handler = type("RepoHandler", (Handler,), {"repos": RepoStore(root), "latency": latency, "error_rate": error_rate})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the ctrlz push server")
+    parser.add_argument("--root", default=".ctrlz-server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds of delay added to every request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail with 503")
+    args = parser.parse_args()
+
+    server = make_server(args.root, args.host, args.port, args.latency, args.error_rate)
+    print(f"Serving {os.path.abspath(args.root)} on http://{args.host}:{server.server_port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
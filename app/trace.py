@@ -0,0 +1,148 @@
+import os
+import sys
+import time
+import threading
+import functools
+from contextlib import nullcontext
+
+# Performance tracing for `--trace-perf` / CTRLZ_TRACE. When on, the hot
+# paths record wall and CPU time per phase plus a few counters (objects
+# read and written, bytes through zlib, HTTP requests), and a JSON report
+# goes to stderr at exit, or to the file CTRLZ_TRACE names.
+#
+# Whether tracing is on is decided once, at import, so that when it's off
+# @traced hands back the undecorated function, phase() a shared null
+# context and count() returns straight away.
+#
+# Phases nest per thread: "push/upload_batch" is upload_batch called under
+# push. A function that recurses into itself is timed once, at the top.
+# Work in a process pool (write-tree --jobs) isn't seen.
+_setting = os.environ.get("CTRLZ_TRACE", "")
+enabled = "--trace-perf" in sys.argv or _setting not in ("", "0")
+REPORT_PATH = _setting if _setting not in ("", "0", "1") else None
+
+_NULL = nullcontext()
+_lock = threading.Lock()
+_local = threading.local()
+_phases = {}        # "outer/inner" -> [calls, wall, cpu]
+_counters = {}
+_requests = {}      # "METHOD endpoint" -> {"Latencies": [...], "Errors": n}
+_started = (time.perf_counter(), time.process_time())
+
+
+class _Phase:
+    __slots__ = ("name", "key", "wall", "cpu")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.key = None
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        if stack and stack[-1] == self.name:
+            # Recursion: the outermost call already covers this one
+            return self
+        stack.append(self.name)
+        self.key = "/".join(stack)
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        if self.key is None:
+            return False
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        _local.stack.pop()
+        with _lock:
+            totals = _phases.setdefault(self.key, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += wall
+            totals[2] += cpu
+        return False
+
+
+def phase(name: str):
+    return _Phase(name) if enabled else _NULL
+
+
+def traced(fn=None, name: str = None):
+    # @traced or @traced(name="...")
+    if fn is None:
+        return functools.partial(traced, name=name)
+    if not enabled:
+        return fn
+    label = name or fn.__name__
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with _Phase(label):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def count(counter: str, amount: int = 1):
+    if not enabled:
+        return
+    with _lock:
+        _counters[counter] = _counters.get(counter, 0) + amount
+
+
+def record_request(method: str, endpoint: str, seconds: float, status=None):
+    # status None means the request never got a response
+    if not enabled:
+        return
+    with _lock:
+        stats = _requests.setdefault(f"{method} {endpoint}", {"Latencies": [], "Errors": 0})
+        stats["Latencies"].append(seconds)
+        if status is None or status >= 400:
+            stats["Errors"] += 1
+
+
+def _percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def report() -> dict:
+    import resource
+    wall = time.perf_counter() - _started[0]
+    cpu = time.process_time() - _started[1]
+    with _lock:
+        phases = {key: {"Calls": calls, "WallSeconds": round(w, 6), "CpuSeconds": round(c, 6)}
+                  for key, (calls, w, c) in sorted(_phases.items())}
+        requests = {}
+        for key, stats in sorted(_requests.items()):
+            latencies = sorted(stats["Latencies"])
+            requests[key] = {
+                "Count": len(latencies),
+                "Errors": stats["Errors"],
+                "Seconds": {"Total": round(sum(latencies), 6), "P50": round(_percentile(latencies, 0.5), 6),
+                            "P90": round(_percentile(latencies, 0.9), 6), "Max": round(latencies[-1], 6)},
+            }
+        counters = dict(sorted(_counters.items()))
+    return {
+        "Command": sys.argv[1:],
+        "WallSeconds": round(wall, 6),
+        "CpuSeconds": round(cpu, 6),
+        "PeakRssBytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "Phases": phases,
+        "Counters": counters,
+        "Requests": requests,
+    }
+
+
+def write_report():
+    import json
+    text = json.dumps(report(), indent=2)
+    if REPORT_PATH:
+        with open(REPORT_PATH, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text, file=sys.stderr)
+
+
+if enabled:
+    import atexit
+    atexit.register(write_report)
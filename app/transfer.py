@@ -0,0 +1,63 @@
+import struct
+
+# Wire format for moving objects between client and server: each object is
+# sent exactly as it is stored (already zlib'd), framed as
+#   <20-byte object id><1-byte kind><8-byte big-endian length><payload>
+# and frames are simply concatenated. A FULL payload is the stored bytes; a
+# DELTA payload is the 20-byte id of a base the receiver already has,
+# followed by a zlib'd delta (app/delta.py) that rebuilds the object from it.
+FRAME = struct.Struct(">20sBQ")
+FULL = 0
+DELTA = 1
+CHUNK_SIZE = 1024 * 1024
+
+
+def stream_objects(store, hashes, delta_bases=None, chunk_size: int = CHUNK_SIZE):
+    # delta_bases maps an object to a base the receiver is known to have
+    delta_bases = delta_bases or {}
+    for sha in hashes:
+        base = delta_bases.get(sha)
+        if base is not None:
+            delta = store.delta_against(sha, base)
+            if delta is not None:
+                yield FRAME.pack(bytes.fromhex(sha), DELTA, 20 + len(delta)) + bytes.fromhex(base)
+                yield delta
+                continue
+        opened = store.open_stored(sha, chunk_size)
+        if opened is None:
+            continue
+        length, chunks = opened
+        yield FRAME.pack(bytes.fromhex(sha), FULL, length)
+        yield from chunks
+
+
+def read_exact(stream, size: int) -> bytes:
+    parts = []
+    while size:
+        part = stream.read(size)
+        if not part:
+            break
+        parts.append(part)
+        size -= len(part)
+    return b"".join(parts)
+
+
+def read_frames(stream, chunk_size: int = CHUNK_SIZE):
+    # Yields (sha, kind, length, chunks). Each frame's chunks have to be consumed
+    # before asking for the next frame.
+    while True:
+        header = read_exact(stream, FRAME.size)
+        if not header:
+            return
+        if len(header) != FRAME.size:
+            raise RuntimeError("Truncated object frame")
+        sha, kind, length = FRAME.unpack(header)
+
+        def chunks(remaining=length):
+            while remaining:
+                part = read_exact(stream, min(chunk_size, remaining))
+                if not part:
+                    raise RuntimeError(f"Truncated object {sha.hex()}")
+                remaining -= len(part)
+                yield part
+        yield sha.hex(), kind, length, chunks()
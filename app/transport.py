@@ -0,0 +1,95 @@
+import os
+import time
+import random
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app import trace
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+JOURNAL_PATH = ".ctrlz/push-journal"
+
+
+class Transport:
+    # One keep-alive session per remote, with timeouts and bounded retries
+    def __init__(self, base_url: str, username: str, reponame: str, concurrency: int = 4,
+                 retries: int = 4, backoff: float = 0.5, timeout=(10, 300)):
+        self.base_url = base_url
+        self.username = username
+        self.reponame = reponame
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(concurrency, 1))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def url(self, endpoint: str, *parts: str) -> str:
+        return "/".join([self.base_url, endpoint, self.username, self.reponame, *parts])
+
+    def request(self, method: str, url: str, body=None, **kwargs):
+        # body may be a callable returning a fresh (generator) body, so a
+        # streamed request can be replayed on retry
+        endpoint = url[len(self.base_url):].strip("/").split("/", 1)[0]
+        for attempt in range(self.retries + 1):
+            started = time.perf_counter()
+            try:
+                data = body() if callable(body) else body
+                response = self.session.request(method, url, data=data, timeout=self.timeout, **kwargs)
+                trace.record_request(method, endpoint, time.perf_counter() - started, response.status_code)
+                if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    return response
+                # Hand a streamed response's connection back to the pool
+                response.close()
+            except (requests.ConnectionError, requests.Timeout):
+                trace.record_request(method, endpoint, time.perf_counter() - started)
+                if attempt == self.retries:
+                    raise
+            time.sleep(self.backoff * 2 ** attempt * (1 + random.random() / 2))
+
+    def get_ref(self, branch: str):
+        return self.request("GET", self.url("refs", branch))
+
+    def update_ref(self, branch: str, sha: str):
+        return self.request("POST", self.url("update-ref"), json={"Ref": branch, "Hash": sha})
+
+
+class PushJournal:
+    # Object ids the server has acknowledged for an in-progress push to
+    # `target`, so an interrupted push can pick up where it stopped
+    def __init__(self, target: str, path: str = JOURNAL_PATH):
+        self.path = path
+        self.acked = set()
+
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                lines = f.read().split()
+            if lines[:2] == ["target", target]:
+                self.acked.update(lines[2:])
+        if not self.acked:
+            with open(path, "w") as f:
+                f.write(f"target {target}\n")
+
+    def record(self, hashes):
+        with open(self.path, "a") as f:
+            f.write("\n".join(hashes) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.acked.update(hashes)
+
+    def finish(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,259 @@
+import os
+import sys
+import json
+import errno
+import signal
+import socket
+import struct
+import ctypes
+import ctypes.util
+import selectors
+
+from app.ignore import IGNORE_FILE, load_ignore_rules
+from app.index import INDEX_PATH
+
+# `ctrlz watch` keeps an inotify watch on every (non-ignored) directory of
+# the worktree and remembers which paths have seen events. Commands ask it
+# over a Unix socket for "everything that changed since <token>" and only
+# rescan those paths.
+#
+# A token is "<generation>:<clock>". The generation changes whenever the
+# watcher can no longer vouch for what it missed (startup, inotify queue
+# overflow, .ctrlzignore edits), and the answer then says Fresh: do a full
+# scan. The client keeps the token from its last full check in
+# .ctrlz/watch-state, with the paths that still differed from the index
+# then, and the index's stat identity; a changed index also means rescan.
+SOCKET_PATH = ".ctrlz/watch.sock"
+STATE_PATH = ".ctrlz/watch-state"
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+EVENT = struct.Struct("iIII")      # wd, mask, cookie, name length
+
+
+class Inotify:
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path: str) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+        return wd
+
+    def rm_watch(self, wd: int):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        # Everything queued right now, as (wd, mask, name)
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = data[offset:offset + length].rstrip(b"\x00")
+                offset += length
+                events.append((wd, mask, os.fsdecode(name)))
+
+
+class Watcher:
+    def __init__(self):
+        self.clock = 0
+        self.dirty = {}
+        self.inotify = None
+        self.reset()
+
+    def reset(self):
+        # Start over: new generation, fresh watches, nothing dirty
+        if self.inotify is None:
+            self.inotify = Inotify()
+        else:
+            for wd in self.dirs:
+                self.inotify.rm_watch(wd)
+        self.generation = os.urandom(4).hex()
+        self.dirty = {}
+        self.dirs = {}
+        self.degraded = False
+        self.rules = load_ignore_rules()
+        self.watch_tree("")
+
+    def watch_tree(self, path: str):
+        try:
+            self.dirs[self.inotify.add_watch(path or ".")] = path
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                # Out of watches (fs.inotify.max_user_watches): we can't see
+                # everything, so every answer has to say Fresh
+                self.degraded = True
+            return
+        try:
+            with os.scandir(path or ".") as it:
+                for entry in it:
+                    child = f"{path}/{entry.name}" if path else entry.name
+                    if (entry.is_dir(follow_symlinks=False) and not entry.name.startswith(".ctrlz")
+                            and not self.rules.ignored(child, True)):
+                        self.watch_tree(child)
+        except FileNotFoundError:
+            pass
+
+    def unwatch_tree(self, path: str):
+        for wd, dir_path in list(self.dirs.items()):
+            if dir_path == path or dir_path.startswith(path + "/"):
+                self.inotify.rm_watch(wd)
+                del self.dirs[wd]
+
+    def mark(self, path: str):
+        self.clock += 1
+        self.dirty[path] = self.clock
+
+    def process(self):
+        for wd, mask, name in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                self.reset()
+                return
+            dir_path = self.dirs.get(wd)
+            if dir_path is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.dirs[wd]
+                continue
+            if name.startswith(".ctrlz"):
+                if not dir_path and name == IGNORE_FILE:
+                    self.reset()
+                    return
+                continue
+            path = f"{dir_path}/{name}" if dir_path else name
+            self.mark(path)
+            if mask & IN_ISDIR:
+                if mask & IN_MOVED_FROM:
+                    self.unwatch_tree(path)
+                elif mask & (IN_CREATE | IN_MOVED_TO) and not self.rules.ignored(path, True):
+                    self.watch_tree(path)
+
+    def answer(self, since) -> dict:
+        self.process()
+        token = f"{self.generation}:{self.clock}"
+        generation, _, clock = (since or "").partition(":")
+        if self.degraded or generation != self.generation:
+            return {"Token": token, "Fresh": True, "Paths": []}
+        clock = int(clock)
+        return {"Token": token, "Fresh": False, "Paths": [p for p, seen in self.dirty.items() if seen > clock]}
+
+    def serve(self, sock_path: str = SOCKET_PATH):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(sock_path)
+        server.listen(16)
+        selector = selectors.DefaultSelector()
+        selector.register(self.inotify.fd, selectors.EVENT_READ, "inotify")
+        selector.register(server, selectors.EVENT_READ, "socket")
+        try:
+            while True:
+                for key, _ in selector.select():
+                    if key.data == "inotify":
+                        self.process()
+                        continue
+                    conn, _ = server.accept()
+                    with conn:
+                        request = json.loads(conn.makefile("rb").readline() or b"{}")
+                        if request.get("Stop"):
+                            conn.sendall(b'{"Stopped": true}\n')
+                            return
+                        conn.sendall(json.dumps(self.answer(request.get("Since"))).encode() + b"\n")
+        finally:
+            selector.close()
+            server.close()
+            os.remove(sock_path)
+
+
+def ask(message: dict, sock_path: str = SOCKET_PATH):
+    # One round trip to the watcher, or None when it isn't running
+    if not os.path.exists(sock_path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(5)
+            conn.connect(sock_path)
+            conn.sendall(json.dumps(message).encode() + b"\n")
+            return json.loads(conn.makefile("rb").readline())
+    except (OSError, ValueError):
+        return None
+
+
+def index_identity(index_path: str = INDEX_PATH):
+    try:
+        st = os.stat(index_path)
+    except FileNotFoundError:
+        return None
+    return [st.st_mtime_ns, st.st_size, st.st_ino]
+
+
+def load_state(path: str = STATE_PATH) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            return {}
+
+
+def save_state(token: str, paths, path: str = STATE_PATH, **extra):
+    # Call after the index is written: the state is only good for that index
+    state = {"Token": token, "Index": index_identity(), "Paths": sorted(paths), **extra}
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+
+def dirty_paths():
+    # (token, paths, state). paths may differ from the index; everything
+    # else is known to match it. paths is None when a full scan is needed,
+    # and token is None when no watcher is running.
+    state = load_state()
+    reply = ask({"Since": state.get("Token")})
+    if reply is None:
+        return None, None, state
+    if reply["Fresh"] or state.get("Index") != index_identity():
+        return reply["Token"], None, state
+    return reply["Token"], set(state["Paths"]) | set(reply["Paths"]), state
+
+
+def run_watcher():
+    if ask({"Since": None}) is not None:
+        print("A watcher is already running for this repository", file=sys.stderr)
+        sys.exit(1)
+    if os.path.exists(SOCKET_PATH):
+        os.remove(SOCKET_PATH)
+    watcher = Watcher()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f"Watching {len(watcher.dirs)} directories on {SOCKET_PATH}", flush=True)
+    try:
+        watcher.serve()
+    except KeyboardInterrupt:
+        pass
+
+
+def stop_watcher() -> bool:
+    return ask({"Stop": True}) is not None
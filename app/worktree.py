@@ -0,0 +1,68 @@
+import os
+import stat
+from typing import NamedTuple
+
+from app.ignore import IgnoreRules
+
+MODE_FILE = 0o100644
+MODE_EXECUTABLE = 0o100755
+MODE_SYMLINK = 0o120000
+MODE_TREE = 0o40000
+
+
+class WorkEntry(NamedTuple):
+    path: str               # relative to the repo root, "/"-separated
+    entry: os.DirEntry
+    stat: os.stat_result    # lstat, cached on the DirEntry (None for directories)
+    mode: int
+
+
+def file_mode(st) -> int:
+    if stat.S_ISLNK(st.st_mode):
+        return MODE_SYMLINK
+    if stat.S_ISDIR(st.st_mode):
+        return MODE_TREE
+    if st.st_mode & 0o111:
+        return MODE_EXECUTABLE
+    return MODE_FILE
+
+
+def walk(top: str = ".", ignore_rules: IgnoreRules = None, dirs: bool = False, lstat: bool = True):
+    # Every file (and, with dirs=True, every directory before its contents)
+    # under top, in git tree order: names sorted with directories compared as
+    # "name/". That's also byte order of the full paths, i.e. index order.
+    # One scandir per directory and one lstat per file; the type bit from
+    # scandir decides is-dir, so ignored directories are skipped unopened.
+    # Symlinks are reported as links, never followed. With lstat=False files
+    # come back with stat and mode None, for callers that know which ones
+    # they need to look at.
+    top = os.path.normpath(top)
+    prefix = "" if top == "." else top.replace(os.sep, "/") + "/"
+    yield from _walk(top, prefix, ignore_rules or IgnoreRules(), dirs, lstat)
+
+
+def _walk(dir_path, prefix, ignore_rules, dirs, lstat):
+    listed = []
+    with os.scandir(dir_path) as it:
+        for entry in it:
+            if entry.name.startswith(".ctrlz"):
+                continue
+            is_dir = entry.is_dir(follow_symlinks=False)
+            path = prefix + entry.name
+            if ignore_rules.ignored(path, is_dir):
+                continue
+            listed.append((entry.name + "/" if is_dir else entry.name, path, entry, is_dir))
+    listed.sort(key=lambda item: item[0])
+
+    for _, path, entry, is_dir in listed:
+        if is_dir:
+            if dirs:
+                yield WorkEntry(path, entry, None, MODE_TREE)
+            yield from _walk(entry.path, path + "/", ignore_rules, dirs, lstat)
+        elif not lstat:
+            if entry.is_file(follow_symlinks=False) or entry.is_symlink():
+                yield WorkEntry(path, entry, None, None)
+            continue
+        st = entry.stat(follow_symlinks=False)
+        if stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode):
+            yield WorkEntry(path, entry, st, file_mode(st))
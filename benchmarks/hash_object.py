@@ -0,0 +1,61 @@
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.main import hash_object
+
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(text):
+    if text[-1].upper() in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1].upper()])
+    return int(text)
+
+
+def make_file(path, size):
+    # Half random, half repeated text so zlib has realistic work to do
+    block = os.urandom(512 * 1024) + b"ctrlz benchmark line\n" * (512 * 1024 // 21)
+    with open(path, "wb") as f:
+        written = 0
+        while written < size:
+            chunk = block[:size - written]
+            f.write(chunk)
+            written += len(chunk)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure hash_object throughput and peak memory")
+    parser.add_argument("sizes", nargs="*", default=["1M", "100M", "2G"])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as repo:
+        os.chdir(repo)
+        os.makedirs(".ctrlz/objects")
+        for text in args.sizes:
+            size = parse_size(text)
+            path = f"input_{text}"
+            make_file(path, size)
+
+            start = time.perf_counter()
+            hash_object(path)
+            cold = time.perf_counter() - start
+
+            # Second run hits the "object already exists" path
+            start = time.perf_counter()
+            hash_object(path)
+            warm = time.perf_counter() - start
+
+            peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            mb = size / 1024 / 1024
+            print(f"{text:>6}: new {mb / cold:8.1f} MB/s | existing {mb / warm:8.1f} MB/s | peak RSS {peak_mb:.1f} MB")
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
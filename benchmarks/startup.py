@@ -0,0 +1,132 @@
+import argparse
+import io
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Local commands worth timing, run inside a small scratch repo
+COMMANDS = [
+    ("hash-object", ["hash-object", "-w", "src/file_0.txt"]),
+    ("cat-file", ["cat-file", "-p", "{blob}"]),
+    ("status", ["status", "--porcelain"]),
+    ("ls-commits", ["ls-commits"]),
+]
+
+
+def run_ctrlz(code_root, repo, args):
+    env = dict(os.environ, PYTHONPATH=code_root)
+    return subprocess.run([sys.executable, "-m", "app.main", *args], cwd=repo, env=env,
+                          capture_output=True, text=True)
+
+
+def import_profile(code_root):
+    # (total us for app.main, [(cumulative us, module)] of its direct imports)
+    env = dict(os.environ, PYTHONPATH=code_root)
+    # Run from code_root: -c puts the working directory first on sys.path
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app.main"],
+                            cwd=code_root, env=env, capture_output=True, text=True, check=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        rows.append((depth, name.strip(), int(cumulative)))
+
+    # importtime prints children before their parent
+    main_at = max(i for i, row in enumerate(rows) if row[1] == "app.main")
+    main_depth, _, total = rows[main_at]
+    children = []
+    for depth, name, cumulative in reversed(rows[:main_at]):
+        if depth <= main_depth:
+            break
+        if depth == main_depth + 1:
+            children.append((cumulative, name))
+    return total, sorted(children, reverse=True)
+
+
+def make_repo(code_root, path, files):
+    os.makedirs(os.path.join(path, "src"))
+    for i in range(files):
+        with open(os.path.join(path, "src", f"file_{i}.txt"), "w") as f:
+            f.write(f"line {i}\n" * 50)
+    run_ctrlz(code_root, path, ["init"])
+    run_ctrlz(code_root, path, ["add", "."])
+    run_ctrlz(code_root, path, ["commit", "-m", "benchmark"])
+    blob = run_ctrlz(code_root, path, ["hash-object", "-w", "src/file_0.txt"]).stdout
+    return "".join(c for c in blob if c in "0123456789abcdef")[-40:]
+
+
+def median_ms(fn, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def measure(code_root, runs, files):
+    results = {}
+    total, children = import_profile(code_root)
+    results["import app.main"] = total / 1000
+    with tempfile.TemporaryDirectory() as repo:
+        blob = make_repo(code_root, repo, files)
+        for label, args in COMMANDS:
+            args = [arg.format(blob=blob) for arg in args]
+            results[label] = median_ms(lambda: run_ctrlz(code_root, repo, args), runs)
+    return results, children
+
+
+def checkout_revision(rev, dest):
+    archive = subprocess.run(["git", "archive", "--format=tar", rev, "app"], cwd=REPO_ROOT,
+                             capture_output=True, check=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(dest)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure ctrlz startup time and what app.main imports")
+    parser.add_argument("--baseline", help="git revision to compare against, e.g. HEAD~1")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--files", type=int, default=200, help="files in the scratch repo")
+    parser.add_argument("--top", type=int, default=10, help="imports to list")
+    args = parser.parse_args()
+
+    interpreter = median_ms(lambda: subprocess.run([sys.executable, "-c", "pass"]), args.runs)
+    current, children = measure(REPO_ROOT, args.runs, args.files)
+    baseline = baseline_children = None
+    if args.baseline:
+        with tempfile.TemporaryDirectory() as old_root:
+            checkout_revision(args.baseline, old_root)
+            baseline, baseline_children = measure(old_root, args.runs, args.files)
+
+    header = f"{'':<18}{'current':>12}"
+    if baseline:
+        header += f"{args.baseline:>14}"
+    print(header)
+    print(f"{'interpreter':<18}{interpreter:>9.1f} ms")
+    for label, value in current.items():
+        line = f"{label:<18}{value:>9.1f} ms"
+        if baseline:
+            line += f"{baseline[label]:>11.1f} ms"
+        print(line)
+
+    for title, rows in (("current", children), (args.baseline, baseline_children)):
+        if rows is None:
+            continue
+        print(f"\nSlowest imports under app.main ({title}, -X importtime cumulative):")
+        for cumulative, name in rows[:args.top]:
+            print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.server import make_server
+from benchmarks.startup import REPO_ROOT, checkout_revision
+from benchmarks.synthetic import SyntheticRepo
+
+# End-to-end timings of the CLI against a synthetic repository. Every command
+# runs as its own process, the way a user runs it, so the numbers include
+# interpreter start-up; peak RSS is that process's own high-water mark.
+#
+#   python -m benchmarks.suite --files 5000 --history 20 --output before.json
+#   python -m benchmarks.suite --rev HEAD~3 --output old.json
+#   python -m benchmarks.suite --compare old.json before.json
+
+OPERATIONS = ["add", "write-tree", "status", "ls-commits", "commit", "checkout", "push", "clone"]
+
+
+class Runner:
+    def __init__(self, code_root: str, repo: str):
+        self.code_root = code_root
+        self.repo = repo
+        self.env = dict(os.environ, PYTHONPATH=code_root)
+
+    def run(self, *args):
+        # (seconds, peak RSS in bytes, stdout) for one ctrlz invocation
+        with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+            start = time.perf_counter()
+            proc = subprocess.Popen([sys.executable, "-m", "app.main", *args], cwd=self.repo,
+                                    env=self.env, stdin=subprocess.DEVNULL, stdout=out, stderr=err)
+            _, status, usage = os.wait4(proc.pid, 0)
+            elapsed = time.perf_counter() - start
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            out.seek(0)
+            err.seek(0)
+            if proc.returncode:
+                raise RuntimeError(f"ctrlz {' '.join(args)} failed: {err.read().decode(errors='replace')}")
+            return elapsed, usage.ru_maxrss * 1024, out.read().decode(errors="replace")
+
+    def ctrlz(self, *args) -> str:
+        return self.run(*args)[2]
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def summarize(samples, units):
+    # samples: [(seconds, rss)]; units: {"Files": n, "Bytes": n, ...} per run
+    times = [seconds for seconds, _ in samples]
+    median = percentile(times, 0.5)
+    result = {
+        "Runs": len(samples),
+        "Seconds": {"Min": min(times), "P50": median, "P90": percentile(times, 0.9),
+                    "P99": percentile(times, 0.99), "Max": max(times), "Mean": sum(times) / len(times)},
+        "PeakRssBytes": max(rss for _, rss in samples),
+        "Throughput": {},
+    }
+    for unit, amount in units.items():
+        result["Throughput"][f"{unit}PerSecond"] = amount / median if median else None
+    return result
+
+
+def head_commit(repo):
+    with open(os.path.join(repo, ".ctrlz/refs/heads/main")) as f:
+        return f.read().strip()
+
+
+def directory_size(path):
+    total = 0
+    for dir_path, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(dir_path, name)) for name in files)
+    return total
+
+
+def run_suite(code_root, args, operations):
+    server_root = tempfile.mkdtemp(prefix="ctrlz-bench-server-")
+    server = make_server(server_root)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    repo = tempfile.mkdtemp(prefix="ctrlz-bench-repo-")
+    results = {}
+    try:
+        synth = SyntheticRepo(repo, files=args.files, depth=args.depth, fanout=args.fanout,
+                              sizes=args.sizes, binary=args.binary, seed=args.seed)
+        runner = Runner(code_root, repo)
+
+        start = time.perf_counter()
+        worktree_bytes = synth.populate()
+        files = len(synth.paths)
+
+        def fresh_repo():
+            shutil.rmtree(os.path.join(repo, ".ctrlz"), ignore_errors=True)
+            runner.ctrlz("init")
+            runner.ctrlz("setRepoInfo", "bench", "synthetic")
+            config_path = os.path.join(repo, ".ctrlz/config.json")
+            with open(config_path) as f:
+                config = json.load(f)
+            config["RemoteUrl"] = f"http://127.0.0.1:{server.server_port}"
+            with open(config_path, "w") as f:
+                json.dump(config, f)
+
+        # add: staging the whole worktree into an empty repository
+        samples = []
+        for _ in range(args.runs if "add" in operations else 1):
+            fresh_repo()
+            samples.append(runner.run("add", ".")[:2])
+        if "add" in operations:
+            results["add"] = summarize(samples, {"Files": files, "Bytes": worktree_bytes})
+
+        # History: the base commit, then `history` commits of churn on top
+        runner.ctrlz("commit", "-m", "base")
+        base = head_commit(repo)
+        for i in range(args.history):
+            synth.edit(args.churn)
+            runner.ctrlz("add", ".")
+            runner.ctrlz("commit", "-m", f"change {i}")
+        files = len(synth.paths)
+        worktree_bytes = synth.size()
+        setup_seconds = time.perf_counter() - start
+
+        if "write-tree" in operations:
+            samples = [runner.run("write-tree")[:2] for _ in range(args.runs)]
+            results["write-tree"] = summarize(samples, {"Files": files, "Bytes": worktree_bytes})
+
+        if "status" in operations:
+            samples = [runner.run("status", "--porcelain")[:2] for _ in range(args.runs)]
+            results["status"] = summarize(samples, {"Files": files})
+
+        if "ls-commits" in operations:
+            samples = [runner.run("ls-commits")[:2] for _ in range(args.runs)]
+            results["ls-commits"] = summarize(samples, {"Commits": args.history + 1})
+
+        if "commit" in operations:
+            samples = []
+            for i in range(args.runs):
+                path = synth.paths[i % len(synth.paths)]
+                with open(os.path.join(repo, path), "ab") as f:
+                    f.write(f"benchmark commit {i}\n".encode())
+                synth.changed.add(path)
+                runner.ctrlz("add", "--", path)
+                samples.append(runner.run("commit", "-m", f"benchmark {i}")[:2])
+            results["commit"] = summarize(samples, {"Commits": 1})
+
+        if "checkout" in operations:
+            # Back and forth between the base commit and the tip; every
+            # switch rewrites the files the history touched
+            tip = head_commit(repo)
+            samples = []
+            for _ in range(args.runs):
+                samples.append(runner.run("checkout", base)[:2])
+                samples.append(runner.run("checkout", tip)[:2])
+            results["checkout"] = summarize(samples, {"Files": len(synth.changed)})
+
+        if "push" in operations:
+            # The whole history into an empty remote, every run
+            samples = []
+            object_bytes = directory_size(os.path.join(repo, ".ctrlz/objects"))
+            for _ in range(args.runs):
+                shutil.rmtree(os.path.join(server_root, "bench"), ignore_errors=True)
+                journal = os.path.join(repo, ".ctrlz/push-journal")
+                if os.path.exists(journal):
+                    os.remove(journal)
+                samples.append(runner.run("push")[:2])
+            results["push"] = summarize(samples, {"Bytes": object_bytes})
+
+        if "clone" in operations:
+            # The whole history out of the remote into a new directory
+            if "push" not in operations:
+                runner.ctrlz("push")
+            object_bytes = directory_size(os.path.join(server_root, "bench"))
+            with tempfile.TemporaryDirectory(prefix="ctrlz-bench-clone-") as scratch:
+                cloner = Runner(code_root, scratch)
+                samples = []
+                for _ in range(args.runs):
+                    shutil.rmtree(os.path.join(scratch, "synthetic"), ignore_errors=True)
+                    samples.append(cloner.run("clone", "bench", "synthetic", "--url",
+                                              f"http://127.0.0.1:{server.server_port}")[:2])
+            results["clone"] = summarize(samples, {"Files": files, "Bytes": object_bytes})
+
+        return results, {"Files": files, "WorktreeBytes": worktree_bytes, "SetupSeconds": setup_seconds}
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(repo, ignore_errors=True)
+        shutil.rmtree(server_root, ignore_errors=True)
+
+
+def describe_code(rev):
+    # (label, commit) for the report
+    commit = subprocess.run(["git", "rev-parse", rev or "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                            text=True).stdout.strip()
+    if rev:
+        return rev, commit
+    dirty = subprocess.run(["git", "status", "--porcelain", "--", "app"], cwd=REPO_ROOT,
+                           capture_output=True, text=True).stdout.strip()
+    return commit[:10] + ("-dirty" if dirty else ""), commit
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{'':<12}{old['Label']:>14}{new['Label']:>14}{'change':>10}   peak RSS")
+    for name in OPERATIONS:
+        if name not in old["Operations"] or name not in new["Operations"]:
+            continue
+        before = old["Operations"][name]
+        after = new["Operations"][name]
+        t0, t1 = before["Seconds"]["P50"], after["Seconds"]["P50"]
+        rss0, rss1 = before["PeakRssBytes"] / 2 ** 20, after["PeakRssBytes"] / 2 ** 20
+        print(f"{name:<12}{t0 * 1000:>11.1f} ms{t1 * 1000:>11.1f} ms{(t1 - t0) / t0 * 100:>+9.1f}%"
+              f"   {rss0:.1f} -> {rss1:.1f} MB")
+    if old["Parameters"] != new["Parameters"]:
+        print("\nWarning: the two reports used different repository parameters", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time ctrlz commands against a synthetic repository")
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--depth", type=int, default=3, help="directory levels below the root")
+    parser.add_argument("--fanout", type=int, default=4, help="subdirectories per directory")
+    parser.add_argument("--sizes", default="lognormal:4K:1.0",
+                        help="file size distribution: fixed:SIZE, uniform:MIN:MAX or lognormal:MEDIAN:SIGMA")
+    parser.add_argument("--binary", type=float, default=0.1, help="fraction of files with random (incompressible) content")
+    parser.add_argument("--history", type=int, default=10, help="commits on top of the base commit")
+    parser.add_argument("--churn", type=float, default=0.02, help="fraction of files changed per commit")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--only", help="comma-separated subset of " + ",".join(OPERATIONS))
+    parser.add_argument("--rev", help="benchmark the app/ tree of this git revision instead of the worktree")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two JSON reports")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    operations = args.only.split(",") if args.only else OPERATIONS
+    for name in operations:
+        if name not in OPERATIONS:
+            parser.error(f"unknown operation {name}")
+
+    with tempfile.TemporaryDirectory() as old_root:
+        code_root = REPO_ROOT
+        if args.rev:
+            checkout_revision(args.rev, old_root)
+            code_root = old_root
+        label, commit = describe_code(args.rev)
+        results, repo_info = run_suite(code_root, args, operations)
+
+    parameters = {name: getattr(args, name) for name in
+                  ("files", "depth", "fanout", "sizes", "binary", "history", "churn", "seed", "runs")}
+    report = {
+        "Label": label,
+        "Commit": commit,
+        "Timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "Python": platform.python_version(),
+        "Platform": platform.platform(),
+        "CpuCount": os.cpu_count(),
+        "Parameters": parameters,
+        "Repository": repo_info,
+        "Operations": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+        for name, result in results.items():
+            print(f"{name:<12}p50 {result['Seconds']['P50'] * 1000:8.1f} ms   p90 {result['Seconds']['P90'] * 1000:8.1f} ms"
+                  f"   peak RSS {result['PeakRssBytes'] / 2 ** 20:6.1f} MB", file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
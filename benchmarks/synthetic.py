@@ -0,0 +1,99 @@
+import os
+import math
+import random
+
+# Reproducible synthetic worktrees: the same seed and parameters always give
+# the same files, directory layout and edit history.
+
+WORDS = ("ctrlz tree blob commit index object delta pack stream chunk hash "
+         "branch merge ref worktree status push fetch clone stage").split()
+
+
+def parse_size(text):
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if text[-1].upper() in units:
+        return int(float(text[:-1]) * units[text[-1].upper()])
+    return int(text)
+
+
+def size_sampler(spec: str, rng: random.Random):
+    # "fixed:4K", "uniform:1K:64K" or "lognormal:8K:1.5" (median, sigma)
+    kind, *args = spec.split(":")
+    if kind == "fixed":
+        size = parse_size(args[0])
+        return lambda: size
+    if kind == "uniform":
+        low, high = parse_size(args[0]), parse_size(args[1])
+        return lambda: rng.randint(low, high)
+    if kind == "lognormal":
+        median, sigma = parse_size(args[0]), float(args[1]) if len(args) > 1 else 1.0
+        mu = math.log(median)
+        return lambda: max(1, int(rng.lognormvariate(mu, sigma)))
+    raise ValueError(f"Unknown size distribution {spec!r}")
+
+
+def make_content(rng: random.Random, size: int, binary: bool) -> bytes:
+    if binary:
+        return rng.randbytes(size)
+    out = []
+    length = 0
+    while length < size:
+        line = " ".join(rng.choices(WORDS, k=rng.randint(4, 12))) + "\n"
+        out.append(line)
+        length += len(line)
+    return "".join(out).encode()[:size]
+
+
+def make_layout(rng: random.Random, depth: int, fanout: int):
+    # Directory paths, "" for the root, at most `depth` levels deep
+    dirs = [""]
+    level = [""]
+    for d in range(depth):
+        level = [f"{parent}/d{d}_{i}".lstrip("/") for parent in level for i in range(fanout)]
+        dirs.extend(level)
+    return dirs
+
+
+class SyntheticRepo:
+    def __init__(self, root: str, files: int = 1000, depth: int = 3, fanout: int = 4,
+                 sizes: str = "lognormal:4K:1.0", binary: float = 0.1, seed: int = 0):
+        self.root = root
+        self.rng = random.Random(seed)
+        self.binary = binary
+        self.sample_size = size_sampler(sizes, self.rng)
+        dirs = make_layout(self.rng, depth, fanout)
+        self.paths = sorted(f"{self.rng.choice(dirs)}/f{i}.{'bin' if self.rng.random() < binary else 'txt'}".lstrip("/")
+                            for i in range(files))
+        self.changed = set()
+
+    def write(self, path: str, size: int = None):
+        full = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        content = make_content(self.rng, size or self.sample_size(), path.endswith(".bin"))
+        with open(full, "wb") as f:
+            f.write(content)
+        return len(content)
+
+    def populate(self) -> int:
+        return sum(self.write(path) for path in self.paths)
+
+    def edit(self, churn: float) -> list:
+        # One commit's worth of changes: rewrite a fraction of the files,
+        # append to a few and add a new one
+        count = max(1, int(len(self.paths) * churn))
+        touched = self.rng.sample(self.paths, min(count, len(self.paths)))
+        for i, path in enumerate(touched):
+            if i % 3 == 0 and not path.endswith(".bin"):
+                with open(os.path.join(self.root, path), "ab") as f:
+                    f.write(make_content(self.rng, 256, False))
+            else:
+                self.write(path)
+        new_path = f"{os.path.dirname(self.rng.choice(self.paths))}/n{len(self.paths)}.txt".lstrip("/")
+        self.write(new_path)
+        self.paths.append(new_path)
+        touched.append(new_path)
+        self.changed.update(touched)
+        return touched
+
+    def size(self) -> int:
+        return sum(os.path.getsize(os.path.join(self.root, path)) for path in self.paths)
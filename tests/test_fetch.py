@@ -0,0 +1,203 @@
+import os
+import sys
+import json
+import random
+import shutil
+import tempfile
+import threading
+import subprocess
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.objects import ObjectStore
+from app.server import make_server
+from app.transfer import FRAME
+from benchmarks.synthetic import SyntheticRepo
+
+# Fetch and clone against app.server on an ephemeral port. The server's
+# handler is subclassed to log every request and, when asked, to hang up
+# part way through a download stream.
+#
+#   python -m unittest tests.test_fetch
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class RecordingHandler:
+    # Mixed into the server's handler class in start_server
+    state = None        # see start_server
+
+    def injected_fault(self):
+        self.state["Requests"].append(f"{self.command} {self.path.strip('/').split('/')[0]}")
+        if super().injected_fault():
+            self.state["Faults"] += 1
+            return True
+        return False
+
+    def read_body(self):
+        body = super().read_body()
+        if self.path.startswith("/download-stream/"):
+            self.state["Downloads"].append(json.loads(body)["Hashes"])
+        return body
+
+    def write_chunk(self, data: bytes):
+        with self.state["Lock"]:
+            left = self.state["CutAfter"]
+            if left is not None:
+                self.state["CutAfter"] = max(0, left - len(data))
+            self.state["BytesSent"] += len(data) if left is None or len(data) <= left else left
+        if left is not None and len(data) > left:
+            # Promise the whole chunk, send part of a frame, hang up
+            self.wfile.write(b"%x\r\n" % len(data) + data[:max(left, FRAME.size // 2)])
+            self.wfile.flush()
+            raise ConnectionAbortedError("download cut")
+        super().write_chunk(data)
+
+
+def start_server(root):
+    server = make_server(root)
+    handler = server.RequestHandlerClass
+    state = {"Requests": [], "Faults": 0, "Downloads": [], "BytesSent": 0, "CutAfter": None,
+             "Lock": threading.Lock()}
+    server.RequestHandlerClass = type("RecordingRepoHandler", (RecordingHandler, handler), {"state": state})
+    server.handle_error = lambda request, client_address: None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+def ctrlz(cwd, *args, check=True):
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+    proc = subprocess.run([sys.executable, "-m", "app.main", *args], cwd=cwd, env=env,
+                          stdin=subprocess.DEVNULL, capture_output=True)
+    if check and proc.returncode:
+        raise AssertionError(f"ctrlz {' '.join(args)} failed:\n{proc.stdout.decode(errors='replace')}"
+                             f"{proc.stderr.decode(errors='replace')}")
+    return proc
+
+
+def object_ids(objects_dir):
+    return set(ObjectStore(objects_dir).iter_hashes())
+
+
+class FetchTest(unittest.TestCase):
+    HISTORY = 3
+
+    def setUp(self):
+        random.seed(0)
+        self.scratch = tempfile.mkdtemp(prefix="ctrlz-test-")
+        self.server, self.state = start_server(os.path.join(self.scratch, "server"))
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+        self.source = os.path.join(self.scratch, "source")
+        os.makedirs(self.source)
+        self.synth = SyntheticRepo(self.source, files=300, depth=2, fanout=3, sizes="lognormal:8K:1.0", seed=1)
+        self.synth.populate()
+        ctrlz(self.source, "init")
+        ctrlz(self.source, "setRepoInfo", "test", "repo")
+        self.set_config(self.source, RemoteUrl=self.url)
+        self.commit_and_push("base")
+        for i in range(self.HISTORY - 1):
+            self.synth.edit(0.05)
+            self.commit_and_push(f"change {i}")
+        self.reset_log()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+    def set_config(self, repo, **values):
+        path = os.path.join(repo, ".ctrlz/config.json")
+        with open(path) as f:
+            config = json.load(f)
+        config.update(values)
+        with open(path, "w") as f:
+            json.dump(config, f)
+
+    def commit_and_push(self, message):
+        ctrlz(self.source, "add", ".")
+        ctrlz(self.source, "commit", "-m", message)
+        ctrlz(self.source, "push")
+
+    def reset_log(self):
+        self.state["Requests"].clear()
+        self.state["Downloads"].clear()
+        self.state["Faults"] = 0
+        self.state["BytesSent"] = 0
+
+    def server_objects(self):
+        # {id: stored size} for everything the server holds
+        objects_dir = os.path.join(self.scratch, "server", "test", "repo", "objects")
+        return {sub + name: os.path.getsize(os.path.join(objects_dir, sub, name))
+                for sub in os.listdir(objects_dir) for name in os.listdir(os.path.join(objects_dir, sub))}
+
+    def clone(self, check=True):
+        return ctrlz(self.scratch, "clone", "test", "repo", "copy", "--url", self.url, check=check)
+
+    def assert_same_worktree(self, clone):
+        for path in self.synth.paths:
+            with open(os.path.join(self.source, path), "rb") as a, open(os.path.join(clone, path), "rb") as b:
+                self.assertEqual(a.read(), b.read(), path)
+
+    def test_clone_and_fetch_survive_server_errors(self):
+        self.server.RequestHandlerClass.error_rate = 0.3
+        self.clone()
+        clone = os.path.join(self.scratch, "copy")
+        self.assertEqual(object_ids(os.path.join(clone, ".ctrlz/objects")), set(self.server_objects()))
+        self.assert_same_worktree(clone)
+        self.assertGreater(self.state["Faults"], 0)
+
+        self.server.RequestHandlerClass.error_rate = 0.0
+        self.synth.edit(0.05)
+        self.commit_and_push("after clone")
+        self.server.RequestHandlerClass.error_rate = 0.3
+        ctrlz(clone, "fetch")
+        self.assertEqual(object_ids(os.path.join(clone, ".ctrlz/objects")), set(self.server_objects()))
+        with open(os.path.join(clone, ".ctrlz/refs/remotes/origin/main")) as f, \
+                open(os.path.join(self.source, ".ctrlz/refs/heads/main")) as g:
+            self.assertEqual(f.read(), g.read())
+
+    def test_interrupted_clone_resumes_from_partial_pack(self):
+        objects = self.server_objects()
+        self.state["CutAfter"] = sum(objects.values()) // 2
+        proc = self.clone(check=False)
+        self.assertNotEqual(proc.returncode, 0)
+        clone = os.path.join(self.scratch, "copy")
+        self.assertEqual(os.listdir(clone), [".ctrlz"])
+        kept = object_ids(os.path.join(clone, ".ctrlz/objects"))
+        self.assertTrue(kept)
+        self.assertLess(len(kept), len(objects))
+        self.assertTrue(kept <= set(objects))
+
+        self.state["CutAfter"] = None
+        self.reset_log()
+        self.clone()
+        asked = [sha for batch in self.state["Downloads"] for sha in batch]
+        self.assertEqual(len(asked), len(set(asked)))
+        self.assertFalse(set(asked) & kept)
+        self.assertEqual(set(asked) | kept, set(objects))
+        self.assert_same_worktree(clone)
+
+    def test_clone_sends_each_object_once_in_few_round_trips(self):
+        objects = self.server_objects()
+        self.clone()
+        # Every object crosses the wire exactly once, framed
+        self.assertEqual(self.state["BytesSent"], sum(objects.values()) + FRAME.size * len(objects))
+        asked = [sha for batch in self.state["Downloads"] for sha in batch]
+        self.assertEqual(sorted(asked), sorted(objects))
+        # One ref read, then at most a pool's worth of requests per level of
+        # the walk (commits, then each tree depth) plus the blob batches
+        concurrency = 4
+        levels = self.HISTORY + 2 + 1
+        self.assertLessEqual(len(self.state["Downloads"]), concurrency * levels + 1)
+        self.assertEqual(self.state["Requests"].count("GET refs"), 1)
+
+        clone = os.path.join(self.scratch, "copy")
+        self.reset_log()
+        ctrlz(clone, "fetch")
+        self.assertEqual(self.state["Requests"], ["GET refs"])
+
+
+if __name__ == "__main__":
+    unittest.main()